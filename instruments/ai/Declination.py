@@ -0,0 +1,205 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Precomputed magnetic declination.
+#
+# geomag is far too slow to call on the GUI thread for every heading update,
+# so declination is sampled on a regular grid, saved to disk, and looked up
+# with bilinear interpolation. geomag is pure Python and would hold the GIL
+# in a background thread just the same, so the grid is computed a few points
+# at a time from a timer on the GUI thread instead, or ahead of time with:
+#
+#   python3 -m instruments.ai.Declination CIFP/declination.npz 24 50 -125 -66
+#
+# Declination changes slowly enough that a 2 degree grid interpolates to
+# within a few hundredths of a degree. The grid is computed at sea level; the
+# change with altitude is well under a tenth of a degree at the altitudes we
+# fly.
+
+try:
+    from PyQt5.QtCore import *
+except:
+    from PyQt4.QtCore import *
+import math
+import os
+import sys
+import time
+import logging
+
+import numpy as np
+
+from geomag import declination
+
+log = logging.getLogger(__name__)
+
+class DeclinationGrid:
+    RESOLUTION = 2.0                    # Degrees between grid points
+    HALF_SPAN = 10.0                    # Degrees either side of the aircraft,
+                                        # when no region is configured
+    MAX_AGE = 365 * 24 * 60 * 60        # Seconds before a saved grid is rebuilt
+    SLICE_TIME = .005                   # Seconds of computing per timer tick
+    def __init__(self, path=None, region=None, resolution=None):
+        """ path is where the grid is saved, or None to keep it in memory only.
+            region is [lat_min, lat_max, lng_min, lng_max] in degrees, or None
+            to cover the area around wherever the aircraft is.
+        """
+        self.path = path
+        self.region = region
+        self.resolution = DeclinationGrid.RESOLUTION if resolution is None else resolution
+        # (lat0, lng0, resolution, values), replaced whole once built
+        self.grid = None
+        self.builder = None
+        self.build_timer = QTimer()
+        self.build_timer.timeout.connect(self.build_slice)
+
+    def lookup(self, lat, lng):
+        """ Returns the declination at lat, lng in degrees, or None if the grid
+            covering it isn't ready yet. Requests that grid if needed.
+        """
+        md = None if self.grid is None else interpolate(self.grid, lat, lng)
+        if md is None:
+            # A saved grid is loaded right away, a new one built later
+            self.request(lat, lng)
+            if self.grid is not None:
+                md = interpolate(self.grid, lat, lng)
+        return md
+
+    def request(self, lat, lng):
+        """ Load or start building a grid covering lat, lng """
+        if self.builder is not None:
+            return
+        region = self.region
+        if region is None or not (region[0] <= lat <= region[1] and
+                                  region[2] <= lng <= region[3]):
+            # Nothing configured, or we've flown out of it
+            region = (lat - DeclinationGrid.HALF_SPAN, lat + DeclinationGrid.HALF_SPAN,
+                      lng - DeclinationGrid.HALF_SPAN, lng + DeclinationGrid.HALF_SPAN)
+        grid = self.load()
+        if grid is not None and interpolate(grid, lat, lng) is not None:
+            self.grid = grid
+            return
+        self.builder = GridBuilder(region, self.resolution)
+        self.build_timer.start(0)
+
+    def build_slice(self):
+        """ Compute the next few points of the grid being built """
+        if not self.builder.step(DeclinationGrid.SLICE_TIME):
+            return
+        self.build_timer.stop()
+        grid = self.builder.grid()
+        log.debug ("Declination grid of %d points computed in %.1f seconds",
+                    grid[3].size, self.builder.elapsed)
+        self.builder = None
+        self.grid = grid
+        self.save(grid)
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        try:
+            if time.time() - os.path.getmtime(self.path) > DeclinationGrid.MAX_AGE:
+                return None
+            with np.load(self.path) as saved:
+                lat0, lng0, resolution = saved['origin'].tolist()
+                values = saved['values']
+        except Exception as e:
+            log.warning ("Unable to read declination grid %s: %s", self.path, str(e))
+            return None
+        if resolution != self.resolution:
+            return None
+        return (lat0, lng0, resolution, values)
+
+    def save(self, grid):
+        if self.path is None:
+            return
+        lat0, lng0, resolution, values = grid
+        try:
+            with open(self.path, 'wb') as fd:
+                np.savez (fd, origin=np.array([lat0, lng0, resolution]), values=values)
+        except Exception as e:
+            log.warning ("Unable to save declination grid %s: %s", self.path, str(e))
+
+class GridBuilder:
+    """ Samples the declination over region, snapped outward to whole grid
+        points, as many points at a time as the caller has time for
+    """
+    def __init__(self, region, resolution):
+        lat_min, lat_max, lng_min, lng_max = region
+        self.resolution = resolution
+        self.lat0 = max(math.floor(lat_min / resolution) * resolution, -89.0)
+        lat1 = min(math.ceil(lat_max / resolution) * resolution, 89.0)
+        self.lng0 = max(math.floor(lng_min / resolution) * resolution, -180.0)
+        lng1 = min(math.ceil(lng_max / resolution) * resolution, 180.0)
+        self.lats = (self.lat0 + np.arange(int(round((lat1 - self.lat0) / resolution)) + 1)
+                        * resolution).tolist()
+        self.lngs = (self.lng0 + np.arange(int(round((lng1 - self.lng0) / resolution)) + 1)
+                        * resolution).tolist()
+        self.values = np.empty((len(self.lats), len(self.lngs)))
+        self.done = 0
+        self.elapsed = 0.0
+
+    def step(self, seconds=None):
+        """ Compute points for about seconds, or all the rest if None.
+            Returns True once the grid is complete.
+        """
+        start = time.time()
+        values = self.values.reshape(-1)
+        cols = len(self.lngs)
+        while self.done < values.size:
+            i, j = divmod(self.done, cols)
+            values[self.done] = declination(self.lats[i], self.lngs[j], 0)
+            self.done += 1
+            if seconds is not None and time.time() - start >= seconds:
+                break
+        self.elapsed += time.time() - start
+        return self.done == values.size
+
+    def grid(self):
+        """ (lat0, lng0, resolution, values) """
+        return (self.lat0, self.lng0, self.resolution, self.values)
+
+def compute_grid(region, resolution):
+    """ Sample the declination over region all at once. Returns
+        (lat0, lng0, resolution, values).
+    """
+    builder = GridBuilder(region, resolution)
+    builder.step()
+    return builder.grid()
+
+def interpolate(grid, lat, lng):
+    """ Bilinear interpolation of the grid at lat, lng. None if outside it. """
+    lat0, lng0, resolution, values = grid
+    fi = (lat - lat0) / resolution
+    fj = (lng - lng0) / resolution
+    rows, cols = values.shape
+    if fi < 0 or fj < 0 or fi > rows - 1 or fj > cols - 1:
+        return None
+    i = min(int(fi), rows - 2)
+    j = min(int(fj), cols - 2)
+    ti = fi - i
+    tj = fj - j
+    top = values[i,j] * (1 - tj) + values[i,j+1] * tj
+    bottom = values[i+1,j] * (1 - tj) + values[i+1,j+1] * tj
+    return float(top * (1 - ti) + bottom * ti)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 6:
+        print ("Usage: %s declination.npz lat_min lat_max lng_min lng_max"%sys.argv[0])
+        sys.exit(-1)
+    region = [float(a) for a in sys.argv[2:]]
+    grid = compute_grid(region, DeclinationGrid.RESOLUTION)
+    DeclinationGrid(sys.argv[1], region).save(grid)
+    print ("Wrote %d points to %s"%(grid[3].size, sys.argv[1]))
@@ -0,0 +1,120 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import math
+
+import numpy as np
+
+RAD_DEG = math.pi / 180.0
+
+class NearestIndex:
+    """ Uniform grid over a set of geographic points, for finding the points
+        nearest a position without looking at all of them.
+        Distances are in nautical miles, on a flat projection around ref_lat.
+    """
+    CELL_SIZE = .1      # Degrees of latitude
+    def __init__(self, lats, lngs, items, ref_lat):
+        self.items = items
+        self.rel_lng = math.cos(ref_lat * RAD_DEG)
+        self.xs = np.asarray(lngs, dtype=float) * self.rel_lng
+        self.ys = np.asarray(lats, dtype=float)
+        self.cells = dict()
+        cxs = np.floor(self.xs / NearestIndex.CELL_SIZE).astype(int)
+        cys = np.floor(self.ys / NearestIndex.CELL_SIZE).astype(int)
+        for i,cell in enumerate(zip(cxs.tolist(), cys.tolist())):
+            self.cells.setdefault(cell, list()).append(i)
+        if len(items) > 0:
+            self.cell_bounds = (cxs.min(), cxs.max(), cys.min(), cys.max())
+
+    def __len__(self):
+        return len(self.items)
+
+    def nearest(self, lat, lng, k=1):
+        """ Returns a list of up to k (distance, item) tuples, nearest first """
+        if len(self.items) == 0:
+            return []
+        x = lng * self.rel_lng
+        y = lat
+        cx = int(math.floor(x / NearestIndex.CELL_SIZE))
+        cy = int(math.floor(y / NearestIndex.CELL_SIZE))
+        minx, maxx, miny, maxy = self.cell_bounds
+        max_ring = max(abs(cx - minx), abs(cx - maxx), abs(cy - miny), abs(cy - maxy))
+        found = list()
+        ring = 0
+        while ring <= max_ring:
+            for cell in ring_cells(cx, cy, ring):
+                for i in self.cells.get(cell, ()):
+                    dx = self.xs[i] - x
+                    dy = self.ys[i] - y
+                    found.append ((math.sqrt(dx * dx + dy * dy) * 60.0, i))
+            # Everything outside the rings searched so far is at least
+            # this far away
+            if len(found) >= k:
+                found.sort()
+                if found[k-1][0] <= ring * NearestIndex.CELL_SIZE * 60.0:
+                    break
+            ring += 1
+        found.sort()
+        return [(d, self.items[i]) for d,i in found[:k]]
+
+def ring_cells(cx, cy, ring):
+    """ The grid cells exactly ring cells away from (cx, cy) """
+    if ring == 0:
+        return [(cx, cy)]
+    ret = [(cx + dx, cy + dy) for dx in range(-ring, ring+1) for dy in (-ring, ring)]
+    ret.extend([(cx + dx, cy + dy) for dx in (-ring, ring) for dy in range(-ring+1, ring)])
+    return ret
+
+class OccupancyGrid:
+    """ Screen space occupied by labels already placed, bucketed into square
+        cells so that a new label is only checked against its neighbours.
+        Rectangles are (left, top, right, bottom) tuples in pixels.
+    """
+    CELL_SIZE = 32      # Pixels
+    def __init__(self, cell_size=None):
+        self.cell_size = cell_size if cell_size is not None else OccupancyGrid.CELL_SIZE
+        self.cells = dict()
+
+    def clear(self):
+        self.cells.clear()
+
+    def cell_range(self, rect):
+        left, top, right, bottom = rect
+        return (range(int(math.floor(left / self.cell_size)),
+                      int(math.floor(right / self.cell_size)) + 1),
+                range(int(math.floor(top / self.cell_size)),
+                      int(math.floor(bottom / self.cell_size)) + 1))
+
+    def occupied(self, rect):
+        """ True if rect overlaps a rectangle already placed """
+        left, top, right, bottom = rect
+        xs, ys = self.cell_range(rect)
+        for cx in xs:
+            for cy in ys:
+                for l,t,r,b in self.cells.get((cx,cy), ()):
+                    if left < r and l < right and top < b and t < bottom:
+                        return True
+        return False
+
+    def place(self, rect):
+        """ Claim rect if it is free. Returns whether it was placed. """
+        if self.occupied(rect):
+            return False
+        xs, ys = self.cell_range(rect)
+        for cx in xs:
+            for cy in ys:
+                self.cells.setdefault((cx,cy), list()).append(rect)
+        return True
@@ -0,0 +1,173 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Terrain elevation from a directory of SRTM .hgt tiles.
+#
+# Each .hgt file covers one degree square and is named for its south west
+# corner, for example N35W107.hgt. It is a square grid of big endian 16 bit
+# elevations in meters, 1201 samples on a side for 3 arc second data or 3601
+# for 1 arc second data, stored north to south. Tiles are memory mapped, so
+# only the pages actually sampled are read from disk.
+
+import collections
+import math
+import mmap
+import os
+import threading
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+FEET_METER = 1.0 / 0.3048
+VOID = -32768
+MAX_LEVEL = 6
+
+def tile_name(lat, lng):
+    """ The .hgt file name of the tile with south west corner lat, lng """
+    return "%s%02d%s%03d.hgt"%("N" if lat >= 0 else "S", abs(lat),
+                                "E" if lng >= 0 else "W", abs(lng))
+
+def pyramid_level(spacing, samples_per_degree):
+    """ The coarsest level whose samples are no farther apart than spacing
+        degrees, in a tile with samples_per_degree intervals per degree at
+        level 0. Works on arrays of spacings too.
+    """
+    levels = np.floor(np.log2(np.maximum(np.asarray(spacing) * samples_per_degree, 1.0)))
+    return np.minimum(levels, MAX_LEVEL).astype(int)
+
+def decimate(grid):
+    """ Every other row and column of a square grid, always including the
+        last ones, so that the result still spans the whole tile. A grid with
+        an even number of samples is resampled at the nearest rows.
+    """
+    last = grid.shape[0] - 1
+    index = np.rint(np.linspace(0, last, last // 2 + 1)).astype(int)
+    return np.ascontiguousarray(grid[np.ix_(index, index)])
+
+class ElevationTiles:
+    """ Least recently used cache of memory mapped .hgt tiles.
+        Level 0 of each tile is the file itself. Higher levels are coarser
+        copies, each taking every other sample of the level below and the
+        edges, for callers that want a rough surface over a wide area.
+        A tile's levels are cached and evicted together, so that a coarse
+        level is never recomputed while its tile is cached.
+        Elevations are returned in feet.
+    """
+    MAX_TILES = 16
+    def __init__(self, directory, max_tiles=None):
+        self.directory = directory
+        self.max_tiles = ElevationTiles.MAX_TILES if max_tiles is None else max_tiles
+        self.lock = threading.Lock()
+        # (lat, lng) -> {level: 2D array of meters, or None where there's no file}
+        # The arrays hold the only reference to their maps, so an evicted
+        # tile is unmapped once nobody is using it any more
+        self.tiles = collections.OrderedDict()
+
+    def tile(self, lat, lng, level=0):
+        """ Returns the elevation grid of the tile with south west corner
+            lat, lng in whole degrees, or None if there is no such file.
+        """
+        key = (lat, lng)
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                if level in self.tiles[key]:
+                    return self.tiles[key][level]
+        if level == 0:
+            grid = self.open_tile(lat, lng)
+        else:
+            grid = self.tile(lat, lng, level - 1)
+            if grid is not None:
+                grid = decimate(grid)
+        with self.lock:
+            self.tiles.setdefault(key, dict())[level] = grid
+            self.tiles.move_to_end(key)
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+        return grid
+
+    def open_tile(self, lat, lng):
+        path = os.path.join(self.directory, tile_name(lat, lng))
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as fd:
+                m = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception as e:
+            log.warning ("Unable to map elevation tile %s: %s", path, str(e))
+            return None
+        size = int(round(math.sqrt(len(m) / 2)))
+        if size * size * 2 != len(m):
+            log.warning ("%s is not a square .hgt tile", path)
+            m.close()
+            return None
+        return np.frombuffer(m, dtype='>i2').reshape(size, size)
+
+    def elevation(self, lat, lng):
+        """ Elevation in feet at lat, lng, or None where there's no data """
+        ilat = int(math.floor(lat))
+        ilng = int(math.floor(lng))
+        grid = self.tile(ilat, ilng)
+        if grid is None:
+            return None
+        last = grid.shape[0] - 1
+        row = int(round((ilat + 1 - lat) * last))
+        col = int(round((lng - ilng) * last))
+        value = grid[row, col]
+        if value == VOID:
+            return None
+        return float(value) * FEET_METER
+
+    def elevations(self, lats, lngs, level=0, default=0.0, spacing=None):
+        """ Elevations in feet at arrays of positions, sampled from the given
+            level. If spacing is given instead, in degrees, each position is
+            sampled from the coarsest level of its tile that is no coarser
+            than that. Positions without data get default.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lngs = np.asarray(lngs, dtype=float)
+        ret = np.full(lats.shape, default, dtype=float)
+        ilats = np.floor(lats).astype(int)
+        ilngs = np.floor(lngs).astype(int)
+        if spacing is not None:
+            spacing = np.broadcast_to(np.asarray(spacing, dtype=float), lats.shape)
+        for ilat, ilng in set(zip(ilats.ravel().tolist(), ilngs.ravel().tolist())):
+            mask = (ilats == ilat) & (ilngs == ilng)
+            if spacing is None:
+                groups = [(level, mask)]
+            else:
+                grid = self.tile(ilat, ilng)
+                if grid is None:
+                    continue
+                levels = np.zeros(lats.shape, dtype=int)
+                levels[mask] = pyramid_level(spacing[mask], grid.shape[0] - 1)
+                groups = [(l, mask & (levels == l)) for l in set(levels[mask].tolist())]
+            for l, group in groups:
+                grid = self.tile(ilat, ilng, l)
+                if grid is None:
+                    continue
+                last = grid.shape[0] - 1
+                rows = np.rint((ilat + 1 - lats[group]) * last).astype(int)
+                cols = np.rint((lngs[group] - ilng) * last).astype(int)
+                values = grid[rows, cols]
+                ret[group] = np.where(values == VOID, default, values * FEET_METER)
+        return ret
+
+    def close(self):
+        with self.lock:
+            self.tiles.clear()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Frame time benchmark for the VirtualVfr terrain layer.
+#
+#   python3 -m instruments.ai.TerrainBenchmark [dem_path]
+#
+# Flies a standard rate turn at 120 knots for FRAMES display ticks over the
+# given .hgt tiles, or over synthetic ridges if no directory is given. Each
+# tick samples or shifts the terrain mesh, builds the band paths and paints
+# them into a WIDTH x HEIGHT image, which is everything the layer adds to a
+# frame. The first tick also opens the tiles and starts the paint engine, so
+# it is reported on its own. Exits non zero if the slowest of the other
+# ticks is over FRAME_BUDGET.
+
+import os
+import sys
+import math
+import tempfile
+import time
+
+import numpy as np
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+try:
+    from PyQt5.QtGui import *
+    from PyQt5.QtCore import *
+    from PyQt5.QtWidgets import *
+except:
+    from PyQt4.QtGui import *
+    from PyQt4.QtCore import *
+
+from instruments.ai.Terrain import tile_name
+from instruments.ai.VirtualVfr import PointOfView, band_path, terrain_colors
+
+WIDTH = 800
+HEIGHT = 480
+FRAMES = 600
+REFRESH_PERIOD = .1
+FRAME_BUDGET = .02          # Seconds, a fifth of the display period
+START = (35.5, -106.5)      # Center of the synthetic tiles
+
+def synthetic_tiles(directory):
+    """ Write 2x2 degrees of 3 arc second ridges around START """
+    size = 1201
+    rows = np.linspace(0, 1, size)[:,np.newaxis]
+    cols = np.linspace(0, 1, size)[np.newaxis,:]
+    for lat in (35, 36):
+        for lng in (-107, -106):
+            ridges = np.sin((lat + 1 - rows) * 40) * np.cos((lng + cols) * 25)
+            grid = (1500 + 1200 * ridges).astype('>i2')
+            grid.tofile(os.path.join(directory, tile_name(lat, lng)))
+
+def run(dem_path):
+    app = QApplication(sys.argv)
+    pov = PointOfView(None, None, REFRESH_PERIOD, dem_path=dem_path)
+    pov.display_width = WIDTH
+    pov.show_object_types.add("Terrain")
+    pov.gps_lat, pov.gps_lng = START
+    pov.altitude = 6500
+    pov.true_heading = 0
+    pov.elevation = pov.approximate_elevation()
+    pov.update_screen(force=True)
+
+    image = QImage(WIDTH, HEIGHT, QImage.Format_RGB32)
+    brushes = [QBrush(c) for c in terrain_colors(PointOfView.TERRAIN_BANDS)]
+    paths = [QPainterPath() for b in brushes]
+    speed = 120.0 / 3600.0 * REFRESH_PERIOD     # nm per tick
+    turn = 3.0 * REFRESH_PERIOD                 # degrees per tick
+    first_time = None
+    rebuilt_times = list()
+    shifted_times = list()
+    for frame in range(FRAMES):
+        pov.true_heading = (pov.true_heading + turn) % 360.0
+        hrad = pov.true_heading * math.pi / 180.0
+        pov.gps_lat += speed * math.cos(hrad) / 60.0
+        pov.gps_lng += speed * math.sin(hrad) / (60.0 * math.cos(pov.gps_lat * math.pi / 180.0))
+        pov.update_screen(force=True)
+
+        start = time.perf_counter()
+        bands, offset, rebuilt = pov.terrain_bands()
+        if rebuilt:
+            # Sized as VirtualVfr.render_terrain sizes them, from the center
+            paths = [band_path(xs, ys, WIDTH / 2, HEIGHT / 2) for xs,ys in bands]
+        painter = QPainter(image)
+        painter.fillRect(0, 0, WIDTH, HEIGHT, Qt.blue)
+        painter.translate(WIDTH / 2 + offset[0], HEIGHT / 2 + offset[1])
+        painter.setPen(Qt.NoPen)
+        for path,brush in zip(paths, brushes):
+            painter.setBrush(brush)
+            painter.drawPath(path)
+        painter.end()
+        elapsed = time.perf_counter() - start
+        if first_time is None:
+            first_time = elapsed
+        else:
+            (rebuilt_times if rebuilt else shifted_times).append(elapsed)
+    pov.stop()
+
+    print ("first     %6.2f ms"%(first_time * 1000))
+    for name,times in (("resampled", rebuilt_times), ("shifted", shifted_times)):
+        if len(times) > 0:
+            print ("%-9s %4d frames  mean %6.2f ms  p99 %6.2f ms  max %6.2f ms"%(name,
+                    len(times), np.mean(times) * 1000, np.percentile(times, 99) * 1000,
+                    np.max(times) * 1000))
+    worst = max(rebuilt_times + shifted_times)
+    print ("Budget %.1f ms: %s"%(FRAME_BUDGET * 1000, "pass" if worst <= FRAME_BUDGET else "FAIL"))
+    return worst <= FRAME_BUDGET
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        ok = run(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            synthetic_tiles(directory)
+            ok = run(directory)
+    sys.exit(0 if ok else 1)
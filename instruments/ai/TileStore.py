@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Packed binary store of the CIFP objects used by the virtual VFR display.
+#
+# The store is compiled once from the FAACIFP18 text file:
+#
+#   python3 -m instruments.ai.TileStore CIFP/FAACIFP18 CIFP/tiles.bin
+#
+# File layout:
+#   header      magic, version, number of tiles
+#   tile table  one entry per 1 degree tile: lat, lng, first record, record count
+#   records     fixed width RECORD entries, grouped by tile
+#
+# Tiles are keyed the same way as the CIFP index.bin file, by the integer
+# degrees of latitude and longitude, truncated toward zero.
+
+import io
+import mmap
+import struct
+import sys
+import logging
+
+import numpy as np
+
+import pyavtools.CIFPObjects as CIFPObjects
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'PYEFTILE'
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+TILE_ENTRY = struct.Struct("<hhII")
+
+RUNWAY = 1
+AIRPORT = 2
+NAVAID = 3
+
+RECORD = np.dtype([('type', 'u1'),
+                   ('lat', '<f8'),
+                   ('lng', '<f8'),
+                   ('elevation', '<i4'),
+                   ('bearing', '<f4'),
+                   ('length', '<i4'),
+                   ('deviation', '<f4'),
+                   ('id', 'S5'),
+                   ('airport_id', 'S4'),
+                   ('name', 'S30')])
+
+def tile_key(lat, lng):
+    return (int(lat), int(lng))
+
+def make_record(o):
+    """ Convert a CIFPObjects object to a RECORD tuple, or None if it isn't
+        stored in tiles.
+    """
+    if isinstance(o, CIFPObjects.Runway):
+        return (RUNWAY, o.lat, o.lng, o.elevation, o.bearing, o.length, 0,
+                o.name.encode(), o.airport_id.encode(), b'')
+    elif isinstance(o, CIFPObjects.Airport):
+        return (AIRPORT, o.lat, o.lng, 0, 0, 0, 0,
+                o.id.encode(), b'', o.name.encode()[:30])
+    elif isinstance(o, CIFPObjects.Navaid):
+        return (NAVAID, o.lat, o.lng, 0, 0, 0, o.deviation,
+                o.id.encode(), b'', o.name.encode()[:30])
+    return None
+
+def make_object(r):
+    """ Convert a RECORD back into the CIFPObjects object it was made from """
+    rtype = r['type']
+    if rtype == RUNWAY:
+        o = CIFPObjects.Runway()
+        o.name = r['id'].decode()
+        o.airport_id = r['airport_id'].decode()
+        o.elevation = int(r['elevation'])
+        o.bearing = float(r['bearing'])
+        o.length = int(r['length'])
+    elif rtype == AIRPORT:
+        o = CIFPObjects.Airport()
+        o.id = r['id'].decode()
+        o.name = r['name'].decode()
+    else:
+        o = CIFPObjects.Navaid()
+        o.id = r['id'].decode()
+        o.name = r['name'].decode()
+        o.deviation = float(r['deviation'])
+    o.lat = float(r['lat'])
+    o.lng = float(r['lng'])
+    return o
+
+def point_records(objects):
+    """ The airports and navaids among a list of CIFPObjects objects, as a
+        RECORD array
+    """
+    records = [make_record(o) for o in objects if not isinstance(o, CIFPObjects.Runway)]
+    return np.array([r for r in records if r is not None], dtype=RECORD)
+
+def compile_tiles(dbfilename, tilefilename):
+    """ Parse the whole CIFP text file once and write the tile store """
+    tiles = dict()
+    with open(dbfilename, 'rb') as cifp:
+        for line in cifp:
+            o = CIFPObjects.parse_line (io.BytesIO(line))
+            if o is None:
+                continue
+            r = make_record(o)
+            if r is not None:
+                tiles.setdefault(tile_key(o.lat, o.lng), list()).append(r)
+
+    keys = sorted(tiles.keys())
+    with open(tilefilename, 'wb') as fd:
+        fd.write (HEADER.pack(MAGIC, VERSION, len(keys)))
+        first = 0
+        for lat,lng in keys:
+            fd.write (TILE_ENTRY.pack(lat, lng, first, len(tiles[lat,lng])))
+            first += len(tiles[lat,lng])
+        for key in keys:
+            fd.write (np.array(tiles[key], dtype=RECORD).tobytes())
+    return first
+
+class TileStore:
+    """ Read only, memory mapped view of a compiled tile store """
+    def __init__(self, tilefilename):
+        with open(tilefilename, 'rb') as fd:
+            self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, ntiles = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError ("%s is not a version %d tile store"%(tilefilename, VERSION))
+        self.tiles = dict()
+        offset = HEADER.size
+        for i in range(ntiles):
+            lat, lng, first, count = TILE_ENTRY.unpack_from(self.map, offset)
+            self.tiles[(lat,lng)] = (first, count)
+            offset += TILE_ENTRY.size
+        self.records_offset = offset
+
+    def records(self, lat, lng):
+        """ The records of one tile, as a NumPy view into the mapped file """
+        first, count = self.tiles.get((lat,lng), (0,0))
+        return np.frombuffer(self.map, dtype=RECORD, count=count,
+                             offset=self.records_offset + first * RECORD.itemsize)
+
+    def find_block(self, lat, lng):
+        """ The runway ends of one tile as CIFPObjects objects, because they
+            are paired as objects, and its airports and navaids as a RECORD
+            array copied out of the file
+        """
+        records = self.records(lat, lng)
+        runways = records['type'] == RUNWAY
+        return [make_object(r) for r in records[runways]], records[~runways]
+
+    def close(self):
+        self.map.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print ("Usage: %s FAACIFP18 tiles.bin"%sys.argv[0])
+        sys.exit(-1)
+    count = compile_tiles(sys.argv[1], sys.argv[2])
+    print ("Wrote %d records to %s"%(count, sys.argv[2]))
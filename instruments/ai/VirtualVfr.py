@@ -14,12 +14,17 @@
 #  along with this program; if not, write to the Free Software
 #  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+import bisect
+import collections
 import copy
+import itertools
 import math
+import queue
+import sys
 import time
 import threading
 
-from geomag import declination
+import numpy as np
 
 try:
     from PyQt5.QtGui import *
@@ -36,6 +41,10 @@ import pyavtools.fix as fix
 from instruments.ai import AI
 import pyavtools.Spatial as Spatial
 import pyavtools.CIFPObjects as CIFPObjects
+from instruments.ai.TileStore import TileStore, point_records, RECORD, RUNWAY, AIRPORT, NAVAID
+from instruments.ai.Declination import DeclinationGrid
+from instruments.ai.Terrain import ElevationTiles
+from instruments.ai.SpatialIndex import NearestIndex, OccupancyGrid
 
 log = logging.getLogger(__name__)
 
@@ -45,54 +54,85 @@ DEG_RAD = 180.0 / M_PI
 
 METERS_FOOT = 0.3048
 FEET_METER = 1.0 / METERS_FOOT
+NAUT_MILES_PER_METER = .0005399568
+FEET_NM = FEET_METER / NAUT_MILES_PER_METER
+NM_FEET = NAUT_MILES_PER_METER / FEET_METER
 EARTH_RADIUS_M=6356752.0
 EARTH_RADIUS=EARTH_RADIUS_M * FEET_METER
 
+# Runway levels of detail
+LOD_DOT = 0         # A single dot
+LOD_OUTLINE = 1     # The runway polygon
+LOD_LABELS = 2      # Polygon, centerline and runway number
+LOD_FULL = 3        # All of that, the extended centerline and PAPI lights
+
 class VirtualVfr(AI):
     CENTERLINE_WIDTH = 3
     MIN_FONT_SIZE=7
+    MAX_FONT_SIZE=25
     RUNWAY_LABEL_FONT_FAMILY="Courier"
     AIRPORT_FONT_FAMILY="Sans"
     AIRPORT_FONT_SIZE=9
     PAPI_YOFFSET = 8
     PAPI_LIGHT_SPACING = 9
+    APPROACH_LOW = 2.5
+    APPROACH_SLIGHTLY_LOW = 2.8
+    APPROACH_SLIGHTLY_HIGH = 3.2
+    APPROACH_VERY_HIGH = 3.5
+    MOVE_THRESHOLD = .5     # Pixels a runway must move before it's redrawn
     VORTAC_ICON_PATH="vortac.png"
+    # Terrain bands shade from hazy in the distance to darker nearby
+    TERRAIN_FAR_COLOR = (150, 150, 140)
+    TERRAIN_NEAR_COLOR = (60, 85, 40)
+    tilesLoaded = pyqtSignal()
     def __init__(self, parent=None):
         super(VirtualVfr, self).__init__(parent)
         self.display_objects = dict()
-        time.sleep(.4)      # Pause to let DB load
+        # Last drawn corner points and PAPI red count of each runway
+        self.runway_states = dict()
+        self.items_created = 0
+        self.items_created_time = time.time()
+        self.papi_red = (QPen(QColor(Qt.red)), QBrush(QColor(Qt.red)))
+        self.papi_white = (QPen(QColor(Qt.white)), QBrush(QColor(Qt.white)))
         self.lng_item = fix.db.get_item("LONG")
         self.lat_item = fix.db.get_item("LAT")
         self.head_item = fix.db.get_item("HEAD")
         self.alt_item = fix.db.get_item("ALT")
-        self.last_mag_update = 0
+        # Used to dead reckon between GPS fixes
+        self.gs_item = fix.db.get_item("GS", wait=False, create=True)
+        self.track_item = fix.db.get_item("TRACK", wait=False, create=True)
+        self.vs_item = fix.db.get_item("VS", wait=False, create=True)
         self.magnetic_declination = None
         self.missing_lat = True
         self.missing_lng = True
-        self.lat = self.lat_item.value
-        self.lng = self.lng_item.value
-        self.altitude = self.alt_item.value
-        self.rendering_prohibited = \
-            self.lng_item.fail or self.lng_item.bad or self.lng_item.old or \
-            self.lat_item.fail or self.lat_item.bad or self.lat_item.old or \
-            self.head_item.fail or self.head_item.bad or self.head_item.old or \
-            self.alt_item.fail or self.alt_item.bad or self.alt_item.old
-        # BUG: convert magnetic heading
-        self.true_heading = self.head_item.value
+        self.lat = 0
+        self.lng = 0
+        self.altitude = 0
+        self.heading = 0
+        self.true_heading = 0
+        self.rendering_prohibited = True
         self.myparent = parent
-        minfont = QFont(VirtualVfr.RUNWAY_LABEL_FONT_FAMILY, VirtualVfr.MIN_FONT_SIZE, QFont.Bold)
-        t = QGraphicsSimpleTextItem ("9 9")
-        t.setFont (minfont)
-        self.min_font_width = t.boundingRect().width()
+        self.declination_grid = DeclinationGrid(
+                    self.myparent.get_config_item('declination_path'),
+                    self.myparent.get_config_item('declination_region'))
+        self.label_font_widths = label_font_widths(VirtualVfr.RUNWAY_LABEL_FONT_FAMILY)
+        self.min_font_width = self.label_font_widths[0]
+        self.label_fonts = dict()
         self.pov = None
-
-    def resizeEvent(self, event):
-        super(VirtualVfr, self).resizeEvent(event)
-        self.pov = PointOfView(self.myparent.get_config_item('dbpath'),
-                               self.myparent.get_config_item('indexpath'),
-                               self.myparent.get_config_item('refresh_period'))
-        self.pov.initialize(["Runway", "Airport"], self.scene.width(),
-                    self.lng, self.lat, self.altitude, self.true_heading)
+        self.terrain_items = list()
+        # Emitted from the tile loader thread, delivered on the GUI thread
+        self.tilesLoaded.connect(self.tiles_loaded)
+
+        # Position and heading changes are collected here and applied
+        # by apply_updates on each tick of the frame clock
+        self.position_changed = False
+        self.heading_changed = False
+        self.altitude_changed = False
+        self.cache_changed = False
+        # Updates received of each item since the last tick
+        self.updates_received = collections.Counter()
+        self.updates_coalesced = 0
+        self.updates_report_time = time.time()
         self.lng_item.valueChanged[float].connect(self.setLongitude)
         self.lng_item.badChanged[bool].connect(self.setBlank)
         self.lng_item.oldChanged[bool].connect(self.setBlank)
@@ -109,36 +149,69 @@ class VirtualVfr(AI):
         self.alt_item.badChanged[bool].connect(self.setBlank)
         self.alt_item.oldChanged[bool].connect(self.setBlank)
         self.alt_item.failChanged[bool].connect(self.setBlank)
+        for item in (self.lng_item, self.lat_item, self.head_item, self.alt_item):
+            item.reportReceived.connect(self.setupItems)
+        # The signals are connected before the items are read, so that a
+        # report arriving in between can't be lost
+        self.setupItems()
+
+    def setupItems(self):
+        """ Read the current state of the database items. Called once the
+            signals are connected, and again whenever the server reports an
+            item, so nothing depends on the database having loaded first.
+        """
+        if item_usable(self.lat_item):
+            self.setLatitude(self.lat_item.value, False)
+        if item_usable(self.lng_item):
+            self.setLongitude(self.lng_item.value, False)
+        if item_usable(self.alt_item):
+            self.setAltitude(self.alt_item.value, False)
+        if item_usable(self.head_item):
+            self.setHeading(self.head_item.value, False)
+        self.setBlank(True)
+
+    def resizeEvent(self, event):
+        super(VirtualVfr, self).resizeEvent(event)
+        # The scene was rebuilt, so none of our items are in it any more
+        self.display_objects = dict()
+        self.runway_states = dict()
+        show = ["Runway", "Airport"]
+        self.terrain_items = list()
+        if self.myparent.get_config_item('terrain') and \
+                self.myparent.get_config_item('dem_path') is not None:
+            # Added before anything else, so that the runways and labels
+            # draw on top of the terrain
+            show.append("Terrain")
+            self.terrain_items = [self.scene.addPath(QPainterPath(), QPen(Qt.NoPen), QBrush(color))
+                                  for color in terrain_colors(PointOfView.TERRAIN_BANDS)]
+            for item in self.terrain_items:
+                item.setZValue(0)
+                item.setVisible(not self.rendering_prohibited)
+        if self.pov is not None:
+            self.pov.stop()
+        self.pov = PointOfView(self.myparent.get_config_item('dbpath'),
+                               self.myparent.get_config_item('indexpath'),
+                               self.myparent.get_config_item('refresh_period'),
+                               self.tilesLoaded.emit,
+                               self.myparent.get_config_item('tilepath'),
+                               self.myparent.get_config_item('view_range'),
+                               self.myparent.get_config_item('runway_lod'),
+                               self.myparent.get_config_item('dem_path'),
+                               self.myparent.get_config_item('cache_budget'))
+        self.pov.initialize(show, self.scene.width(),
+                    self.lng, self.lat, self.altitude, self.true_heading)
         if not self.rendering_prohibited:
             self.pov.render(self)
 
     def get_largest_font_size(self, width):
-        max_size = 25
-        min_size = VirtualVfr.MIN_FONT_SIZE
-        incr = (max_size - min_size) / 4
-        ret = (max_size - min_size) / 2
-        t = QGraphicsSimpleTextItem ("9 9")
-        while True:
-            font = QFont(VirtualVfr.RUNWAY_LABEL_FONT_FAMILY, ret, QFont.Bold)
-            t.setFont (font)
-            if t.boundingRect().width() * 1.5 > width:
-                max_size = ret
-                ret -= incr
-                if ret < min_size:
-                    ret = min_size
-                    break
-            else:
-                break
-        incr = int((max_size - min_size) / 2)
-        while incr > 0:
-            ret += incr
-            font = QFont(VirtualVfr.RUNWAY_LABEL_FONT_FAMILY, ret, QFont.Bold)
-            t.setFont (font)
-            if t.boundingRect().width() * 1.1 > width:
-                ret -= incr
-                incr /= 2
-                incr = int(incr)
-        return ret
+        """ Largest runway label font size that fits in width pixels """
+        i = bisect.bisect_right(self.label_font_widths, width / 1.1)
+        return max(VirtualVfr.MIN_FONT_SIZE, VirtualVfr.MIN_FONT_SIZE + i - 1)
+
+    def get_label_font(self, size):
+        if size not in self.label_fonts:
+            self.label_fonts[size] = QFont(VirtualVfr.RUNWAY_LABEL_FONT_FAMILY, size, QFont.Bold)
+        return self.label_fonts[size]
 
     def get_runway_labels(self, name):
         rwnum_string = ''.join([d for d in name if d >= '0' and d <= '9'])
@@ -156,10 +229,51 @@ class VirtualVfr(AI):
         return ret
 
     def render_runway(self, p11, p12, p21, p22, touchdown_distance,
-                            elevation, length, bearing, name, airport_id, zoom):
+                            elevation, length, bearing, name, airport_id, zoom,
+                            lod=LOD_FULL):
+        """ Draw a runway at level of detail lod: a dot, the outline, the
+            outline with centerline and label, or all that plus the extended
+            centerline and PAPI lights.
+        """
         if not self.isVisible():
             return
 
+        key = name+airport_id
+        # Only full detail draws the PAPI lights, so the red count can't
+        # change what the other levels look like
+        papi_redcount = None
+        if lod == LOD_FULL:
+            papi_redcount = self.get_papi_redcount (touchdown_distance, elevation)
+        points = (p11, p12, p21, p22)
+        state = self.runway_states.get(key)
+        if state is not None and state[1:] == (papi_redcount, lod) and \
+                (key in self.display_objects or key + "_d" in self.display_objects):
+            moved = max([max(abs(p[0] - q[0]), abs(p[1] - q[1]))
+                            for p,q in zip(points, state[0])])
+            if moved < VirtualVfr.MOVE_THRESHOLD:
+                return
+        if state is not None and state[2] != lod:
+            # Drop whatever the previous level of detail drew
+            self.eliminate_runway (name, airport_id)
+        self.runway_states[key] = (points, papi_redcount, lod)
+
+        if lod == LOD_DOT:
+            dkey = key + "_d"
+            x = self.scene.width()/2 + sum([p[0] for p in points]) / 4
+            y = self.scene.height()/2 + sum([p[1] for p in points]) / 4
+            if dkey in self.display_objects:
+                dot = self.display_objects[dkey]
+            else:
+                rect = QRectF (QPointF(-1.5,-1.5), QPointF(1.5,1.5))
+                dot = self.scene.addEllipse (rect, QPen(QColor(Qt.white)),
+                                                QBrush(QColor(Qt.white)))
+                self.count_item_creation()
+                dot.setZValue(0)
+                self.display_objects[dkey] = dot
+            dot.setX(x)
+            dot.setY(y)
+            return
+
         rwlabels = self.get_runway_labels (name)
         if p11[1] > p21[1]:
             draw_width = abs(p11[0] - p12[0])
@@ -176,7 +290,6 @@ class VirtualVfr(AI):
                 left_bottom = p22
             label = rwlabels[1]
 
-        key = name+airport_id
         if key in self.display_objects:
             # print ("update existing runway polygon %s"%key)
             poly = QPolygonF([QPoint(*p11), QPoint(*p12), QPoint(*p21), QPoint(*p22)])
@@ -190,6 +303,7 @@ class VirtualVfr(AI):
             if label[-1] == "W":
                 brush = QBrush(QColor("#000070"))
             rw = self.scene.addPolygon(poly, pen, brush)
+            self.count_item_creation()
             rw.setX(self.scene.width()/2)
             rw.setY(self.scene.height()/2)
             rw.setZValue(0)
@@ -207,7 +321,8 @@ class VirtualVfr(AI):
         centerline = None
         centerline_function = get_line(clpoints, FOFY)
         clkey = key + "_c"
-        if dist1 > 3 * VirtualVfr.CENTERLINE_WIDTH and dist2 > 3*VirtualVfr.CENTERLINE_WIDTH and \
+        if lod >= LOD_LABELS and \
+                dist1 > 3 * VirtualVfr.CENTERLINE_WIDTH and dist2 > 3*VirtualVfr.CENTERLINE_WIDTH and \
                 abs(clpoints[0][1]-clpoints[1][1]) > 5*VirtualVfr.CENTERLINE_WIDTH:
             # Runway polygon large enough to add a centerline
             cline_function = get_line (clpoints, FOFY)
@@ -229,6 +344,7 @@ class VirtualVfr(AI):
                 clpen = QPen(QBrush(QColor(Qt.white)), VirtualVfr.CENTERLINE_WIDTH, Qt.DashLine)
                 clpen.setWidth(VirtualVfr.CENTERLINE_WIDTH)
                 centerline = self.scene.addLine (cline, clpen)
+                self.count_item_creation()
                 centerline.setX(self.scene.width()/2)
                 centerline.setY(self.scene.height()/2)
                 centerline.setZValue(0)
@@ -239,17 +355,19 @@ class VirtualVfr(AI):
             if draw_width > self.min_font_width*1.5:
                 #print ("Runway label will fit underneath runway polygon. font size is %d"%font_size)
                 font_size = self.get_largest_font_size(draw_width)
-                font = QFont(VirtualVfr.RUNWAY_LABEL_FONT_FAMILY, font_size, QFont.Bold)
+                font = self.get_label_font(font_size)
                 label = label[0] + " " + label[1:]
                 if lkey in self.display_objects:
                     # Update label position
                     qlabel = self.display_objects[lkey]
-                    qlabel.setFont(font)
+                    if qlabel.font().pointSize() != font_size:
+                        qlabel.setFont(font)
                     qlabel.setX(self.scene.width()/2 + left_bottom[0])
                     qlabel.setY(self.scene.height()/2 + left_bottom[1])
                 else:
                     # Create new label
                     qlabel = self.scene.addSimpleText(label, font)
+                    self.count_item_creation()
                     qlabel.setPen(QPen(QColor(Qt.black)))
                     qlabel.setBrush(QBrush(QColor(Qt.white)))
                     qlabel.setX(self.scene.width()/2 + left_bottom[0])
@@ -279,7 +397,7 @@ class VirtualVfr(AI):
         bottom_intercept = F(self.scene.height()/2, centerline_function)
         elkey = key + "_e"
         pkey = key + "_p"
-        if abs(bottom_intercept) < self.scene.width():
+        if lod >= LOD_FULL and abs(bottom_intercept) < self.scene.width():
             if clpoints[0][1] > clpoints[1][1]:
                 touchdown_point = QPoint (*clpoints[0])
             else:
@@ -292,6 +410,7 @@ class VirtualVfr(AI):
             else:
                 extendedline = self.scene.addLine (eline,
                     QPen(QColor(Qt.white), 1, Qt.DashLine))
+                self.count_item_creation()
                 extendedline.setX(self.scene.width()/2)
                 extendedline.setY(self.scene.height()/2)
                 extendedline.setZValue(0)
@@ -299,49 +418,29 @@ class VirtualVfr(AI):
                 #print ("%s extendedline %s->%s"%(key, touchdown_point, extended_point))
 
             # Draw PAPI lights
-            height_touchdown = self.altitude - elevation
-            approach_angle = math.atan(height_touchdown / touchdown_distance) * DEG_RAD
-            self.approach_low = 2.5
-            self.approach_slightly_low = 2.8
-            self.approach_slightly_high = 3.2
-            self.approach_very_high = 3.5
-            if approach_angle < self.approach_low:
-                papi_redcount = 4
-            elif approach_angle < self.approach_slightly_low:
-                papi_redcount = 3
-            elif approach_angle < self.approach_slightly_high:
-                papi_redcount = 2
-            elif approach_angle < self.approach_very_high:
-                papi_redcount = 1
-            else:
-                papi_redcount = 0
             papi_total_width = 5 * VirtualVfr.PAPI_LIGHT_SPACING
             x = left_bottom[0] - papi_total_width + VirtualVfr.PAPI_LIGHT_SPACING/2
             y = left_bottom[1] - VirtualVfr.PAPI_YOFFSET
             x += self.scene.width()/2
             y += self.scene.height()/2
-            wpen = QPen(QColor(Qt.white))
-            rpen = QPen(QColor(Qt.red))
-            wbsh = QBrush(QColor(Qt.white))
-            rbsh = QBrush(QColor(Qt.red))
             if pkey in self.display_objects:
                 lights = self.display_objects[pkey]
+                recolor = state is None or state[1] != papi_redcount
             else:
-                lights = list()
-            for i in range(4):
                 rect = QRectF (QPointF(-2,-2), QPointF(2,2))
-                pen,bsh = (rpen,rbsh) if papi_redcount > 0 else (wpen,wbsh)
-                light = self.scene.addEllipse (rect, pen, bsh)
+                lights = [self.scene.addEllipse (rect) for i in range(4)]
+                self.count_item_creation(4)
+                self.display_objects[pkey] = lights
+                recolor = True
+            for light in lights:
+                if recolor:
+                    pen,bsh = self.papi_red if papi_redcount > 0 else self.papi_white
+                    light.setPen(pen)
+                    light.setBrush(bsh)
                 light.setX(x)
                 light.setY(y)
-                if len(lights) < i+1:
-                    lights.append(light)
-                else:
-                    self.scene.removeItem (lights[i])
-                    lights[i] = light
                 x += VirtualVfr.PAPI_LIGHT_SPACING
                 papi_redcount -= 1
-                self.display_objects[pkey] = lights
         else:
             if elkey in self.display_objects:
                 self.scene.removeItem (self.display_objects[elkey])
@@ -352,8 +451,55 @@ class VirtualVfr(AI):
                 del self.display_objects[pkey]
 
 
+    def render_terrain(self, bands, offset, rebuilt):
+        """ Draw the terrain bands from PointOfView.terrain_bands. The band
+            paths are only rebuilt when the mesh is resampled; in between they
+            are just moved by offset.
+        """
+        if not self.isVisible():
+            return
+        w2 = self.scene.width()/2
+        h2 = self.scene.height()/2
+        if rebuilt:
+            for item,(xs,ys) in zip(self.terrain_items, bands):
+                item.setPath(band_path(xs, ys, w2, h2))
+        for item in self.terrain_items:
+            item.setPos(w2 + offset[0], h2 + offset[1])
+
+    def count_item_creation(self, count=1):
+        """ Keep track of how many scene items are created. Steady state
+            rendering shouldn't create any.
+        """
+        self.items_created += count
+
+    def report_item_creation(self, now):
+        """ Log the scene item creation rate for debugging, once a second.
+            Called on every display tick, so quiet seconds are logged too.
+        """
+        elapsed = now - self.items_created_time
+        if elapsed >= 1.0:
+            log.debug ("%.1f scene items created per second", self.items_created / elapsed)
+            self.items_created = 0
+            self.items_created_time = now
+
+    def get_papi_redcount(self, touchdown_distance, elevation):
+        height_touchdown = self.altitude - elevation
+        approach_angle = math.atan(height_touchdown / touchdown_distance) * DEG_RAD
+        if approach_angle < VirtualVfr.APPROACH_LOW:
+            return 4
+        elif approach_angle < VirtualVfr.APPROACH_SLIGHTLY_LOW:
+            return 3
+        elif approach_angle < VirtualVfr.APPROACH_SLIGHTLY_HIGH:
+            return 2
+        elif approach_angle < VirtualVfr.APPROACH_VERY_HIGH:
+            return 1
+        else:
+            return 0
+
     def eliminate_runway (self, name, airport_id):
         key = name+airport_id
+        if key in self.runway_states:
+            del self.runway_states[key]
         if key in self.display_objects:
             self.scene.removeItem (self.display_objects[key])
             del self.display_objects[key]
@@ -380,15 +526,20 @@ class VirtualVfr(AI):
                 for l in self.display_objects[pkey]:
                     self.scene.removeItem (l)
                 del self.display_objects[pkey]
+        dkey = key + "_d"
+        if dkey in self.display_objects:
+            self.scene.removeItem (self.display_objects[dkey])
+            del self.display_objects[dkey]
 
 
-    def render_airport(self, point, name, airport_id, zoom, space_occupied):
+    def render_airport(self, point, name, airport_id, zoom, labels):
         akey = airport_id
         if akey in self.display_objects:
             ap = self.display_objects[akey]
         else:
             font = QFont(VirtualVfr.AIRPORT_FONT_FAMILY, VirtualVfr.AIRPORT_FONT_SIZE, QFont.Bold)
             ap = self.scene.addSimpleText(airport_id, font)
+            self.count_item_creation()
             ap.setPen(QPen(QColor(Qt.blue)))
             ap.setBrush(QBrush(QColor(Qt.white)))
             ap.setZValue(0)
@@ -398,12 +549,8 @@ class VirtualVfr(AI):
         ap.setX(xoff)
         yoff = self.scene.height()/2 + point[1] - rect.height()/2
         ap.setY(yoff)
-        rect.translate(xoff,yoff)
-        for s in space_occupied:
-            if s.intersects(rect):
-                self.eliminate_airport(airport_id)
-                return None
-        return rect
+        if not labels.place((xoff, yoff, xoff + rect.width(), yoff + rect.height())):
+            self.eliminate_airport(airport_id)
 
     def eliminate_airport(self, airport_id):
         akey = airport_id
@@ -412,7 +559,7 @@ class VirtualVfr(AI):
             self.scene.removeItem(ap)
             del self.display_objects[akey]
 
-    def render_navaid(self, point, navaid_id):
+    def render_navaid(self, point, navaid_id, labels):
         vkey = navaid_id
         vlkey = navaid_id + "_l"
         if vkey in self.display_objects:
@@ -425,6 +572,7 @@ class VirtualVfr(AI):
             vtlabel.setBrush(QBrush(QColor(Qt.white)))
             vtlabel.setZValue(0)
             vticon = self.scene.addPixmap (QPixmap (VirtualVfr.VORTAC_ICON_PATH))
+            self.count_item_creation(2)
             self.display_objects[vlkey] = vtlabel
             self.display_objects[vkey] = vticon
         rect = vtlabel.boundingRect()
@@ -432,12 +580,18 @@ class VirtualVfr(AI):
         vtlabel.setX(xoff)
         yoff = self.scene.height()/2 + point[1]
         vtlabel.setY(yoff)
+        left = xoff
+        right = xoff + rect.width()
+        bottom = yoff + rect.height()
 
         rect = vticon.boundingRect()
         xoff = self.scene.width()/2 + point[0] - rect.width()/2
         vticon.setX(xoff)
         yoff = self.scene.height()/2 + point[1] - rect.height()
         vticon.setY(yoff)
+        if not labels.place((min(left, xoff), yoff,
+                             max(right, xoff + rect.width()), bottom)):
+            self.eliminate_navaid(navaid_id)
 
     def eliminate_navaid(self, navaid_id):
         vkey = navaid_id
@@ -448,37 +602,102 @@ class VirtualVfr(AI):
             del self.display_objects[vkey]
             del self.display_objects[vlkey]
 
-    def setLatitude(self, lat):
+    def setLatitude(self, lat, received=True):
         self.lat = lat
         self.missing_lat = False
-        #print ("New latitude %f"%self.lat)
-        self.pov.update_position (self.lat, self.lng)
-        if not self.rendering_prohibited:
-            self.pov.render(self)
+        self.position_changed = True
+        if received:
+            self.updates_received['LAT'] += 1
 
-    def setLongitude(self, lng):
+    def setLongitude(self, lng, received=True):
         self.lng = lng
         self.missing_lng = False
-        #print ("New longitude %f"%self.lng)
-        self.pov.update_position (self.lat, self.lng)
-        if not self.rendering_prohibited:
-            self.pov.render(self)
+        self.position_changed = True
+        if received:
+            self.updates_received['LONG'] += 1
 
-    def setAltitude(self, alt):
+    def setAltitude(self, alt, received=True):
         self.altitude = alt
-        self.pov.update_altitude (alt)
-
-    def setHeading(self, heading):
-        curtime = time.time()
-        if curtime - self.last_mag_update > 60 or self.magnetic_declination is None:
-            # update every minute at the most
+        self.altitude_changed = True
+        if received:
+            self.updates_received['ALT'] += 1
+
+    def setHeading(self, heading, received=True):
+        self.heading = heading
+        self.heading_changed = True
+        if received:
+            self.updates_received['HEAD'] += 1
+
+    def tiles_loaded(self):
+        self.cache_changed = True
+
+    def frame(self):
+        """ Tick of the frame clock, ours or the compositor's """
+        super(VirtualVfr, self).frame()
+        self.apply_updates()
+
+    def apply_updates(self):
+        """ Called once per frame tick. Applies all the position, heading
+            and altitude changes that came in since the last tick, and renders
+            once. Between GPS fixes, the position is dead reckoned.
+        """
+        now = time.time()
+        self.report_item_creation(now)
+        if now - self.updates_report_time >= 10.0:
+            log.debug ("%d updates coalesced in %.0f seconds",
+                        self.updates_coalesced, now - self.updates_report_time)
+            self.updates_coalesced = 0
+            self.updates_report_time = now
+        if self.pov is None or self.missing_lat or self.missing_lng:
+            # Nothing to show until the first position arrives, so nothing
+            # is coalesced either
+            self.updates_received.clear()
+            return
+        motion = self.pov.motion
+        if self.position_changed:
+            gs = self.gs_item.value if item_usable(self.gs_item) else 0
+            if item_usable(self.track_item):
+                track = self.track_item.value
+            elif self.pov.track is not None:
+                track = self.pov.track
+            else:
+                track = self.true_heading
+            motion.position_fix (self.lat, self.lng, gs, track, now)
+        if self.altitude_changed:
+            vs = self.vs_item.value if item_usable(self.vs_item) else 0
+            motion.altitude_fix (self.altitude, vs, now)
+        moving = motion.moving(now)
+        if not (self.position_changed or self.heading_changed or
+                self.altitude_changed or self.cache_changed or moving):
+            return
+        # Only the last update of each value is applied. A LAT and LONG
+        # pair is one position fix.
+        received = self.updates_received
+        for count in (max(received['LAT'], received['LONG']), received['ALT'], received['HEAD']):
+            self.updates_coalesced += max(count - 1, 0)
+        received.clear()
+
+        if self.heading_changed or self.position_changed:
             if not (self.missing_lat or self.missing_lng):
-                self.last_mag_update = curtime
-                self.magnetic_declination = declination (self.lat, self.lng, self.altitude)
-        md = self.magnetic_declination
-        if md is None:
-            md = 0
-        self.pov.update_heading (heading + md)
+                # Until the grid is ready the last value, if any, is kept
+                md = self.declination_grid.lookup (self.lat, self.lng)
+                if md is not None:
+                    self.magnetic_declination = md
+            md = self.magnetic_declination
+            if md is None:
+                md = 0
+            self.true_heading = self.heading + md
+        if moving:
+            lat, lng = motion.predict(now)
+        else:
+            lat, lng = self.lat, self.lng
+        alt = motion.predict_altitude(now, self.altitude)
+        self.pov.update (lat, lng, self.true_heading, alt,
+                            self.position_changed or self.cache_changed or moving)
+        self.position_changed = False
+        self.heading_changed = False
+        self.altitude_changed = False
+        self.cache_changed = False
         if not self.rendering_prohibited:
             self.pov.render(self)
 
@@ -489,15 +708,100 @@ class VirtualVfr(AI):
             self.head_item.fail or self.head_item.bad or self.head_item.old or \
             self.alt_item.fail or self.alt_item.bad or self.alt_item.old
         if self.rendering_prohibited and len(self.display_objects) > 0:
-            for key in self.display_objects.keys():
-                self.scene.removeItem(self.display_objects[key])
+            for item in self.display_objects.values():
+                if isinstance(item, list):
+                    for i in item:
+                        self.scene.removeItem(i)
+                else:
+                    self.scene.removeItem(item)
             self.display_objects = dict()
+            self.runway_states = dict()
+        for item in self.terrain_items:
+            item.setVisible(not self.rendering_prohibited)
+
+def band_path(xs, ys, w2, h2):
+    """ Path of a terrain band with top edge xs, ys. It's filled down to h2
+        and out to +-w2, so it still covers the view when banked.
+    """
+    poly = QPolygonF([QPointF(-w2, h2), QPointF(-w2, ys[0])])
+    for x,y in zip(xs.tolist(), ys.tolist()):
+        poly.append (QPointF(x, y))
+    poly.append (QPointF(w2, ys[-1]))
+    poly.append (QPointF(w2, h2))
+    path = QPainterPath()
+    path.addPolygon(poly)
+    path.closeSubpath()
+    return path
+
+def terrain_colors(count):
+    """ Colors of count terrain bands, farthest first """
+    far = VirtualVfr.TERRAIN_FAR_COLOR
+    near = VirtualVfr.TERRAIN_NEAR_COLOR
+    colors = list()
+    for i in range(count):
+        t = i / max(count - 1, 1)
+        colors.append (QColor(*[int(round(f + (n - f) * t)) for f,n in zip(far, near)]))
+    return colors
+
+# Widths of runway label text at each font size, by font family
+font_width_tables = dict()
+
+def label_font_widths(family):
+    """ Returns a list of the pixel widths of a runway label for each font size
+        from VirtualVfr.MIN_FONT_SIZE to VirtualVfr.MAX_FONT_SIZE. Text is only
+        measured the first time a font family is asked for.
+    """
+    if family not in font_width_tables:
+        t = QGraphicsSimpleTextItem ("9 9")
+        widths = list()
+        for size in range(VirtualVfr.MIN_FONT_SIZE, VirtualVfr.MAX_FONT_SIZE+1):
+            t.setFont (QFont(family, size, QFont.Bold))
+            # Keep the list sorted for bisect, even if the font has odd metrics
+            widths.append (max([t.boundingRect().width()] + widths[-1:]))
+        font_width_tables[family] = widths
+    return font_width_tables[family]
+
+def item_usable(item):
+    return not (item.fail or item.bad or item.old)
 
 VIEWPORT_ANGLE100 = 35.0 / 2.0 * RAD_DEG
 
 class PointOfView:
-    sorted_object_types = ["Airport", "Fix"]
-    def __init__(self, dbpath, index_path, refresh_period):
+    # BlockTable point type of each object type drawn at a single point
+    POINT_TYPES = {"Airport": AIRPORT, "NAVAID": NAVAID}
+    # Label placement priority. Airports are ranked by their longest runway,
+    # in feet, and always win over navaids.
+    AIRPORT_PRIORITY = [8000, 5000, 3000]
+    NAVAID_PRIORITY = len(AIRPORT_PRIORITY) + 1
+    PREFETCH_DISTANCE = 45.0    # Nautical miles ahead along track
+    VIEW_RANGE = 60.0           # Default view range in nautical miles
+    CULL_MARGIN = 10.0          # Degrees added to either side of the view cone
+    CULL_NEAR = 2.0             # Nautical miles. Anything closer is never culled
+    # Runway level of detail thresholds. Each tier needs the runway to be at
+    # least size pixels across on screen and within distance nautical miles.
+    # Once shown, a tier is kept until the runway is out of range by more
+    # than the hysteresis fraction. The PAPI lights and extended centerline
+    # are approach aids, so the full tier goes by distance alone: on a
+    # 3 degree final a runway is only about 10 pixels across at 5 nm.
+    RUNWAY_LOD = {'outline': (3, 40.0),
+                  'labels': (12, 20.0),
+                  'full': (0, 10.0),
+                  'hysteresis': .2}
+    # Terrain mesh, sampled in rings of distance across the view cone
+    TERRAIN_RINGS = 24
+    TERRAIN_COLUMNS = 41
+    TERRAIN_BANDS = 6
+    TERRAIN_NEAR = .5           # Nautical miles to the nearest ring
+    # Changes that make the mesh be resampled. Smaller ones just shift it.
+    TERRAIN_TURN = 2.0          # Degrees
+    TERRAIN_MOVE = .2           # Nautical miles
+    TERRAIN_CLIMB = 100.0       # Feet
+    CACHE_BUDGET = 32           # Megabytes of cache blocks kept in memory
+    BLOCK_OVERHEAD = 4096       # Bytes each cache block costs, even an empty one
+    WINDOW_HYSTERESIS = .1      # Degrees past a block edge before the window moves
+    def __init__(self, dbpath, index_path, refresh_period, tile_callback=None,
+                    tilepath=None, view_range=None, runway_lod=None, dem_path=None,
+                    cache_budget=None):
         # Inputs
         self.altitude = 0
         self.gps_lat = 0
@@ -509,15 +813,66 @@ class PointOfView:
         self.index_path = index_path
         self.dbpath = dbpath
         self.refresh_period = .1 if refresh_period is None else refresh_period
-        self.cache_refresh_period = self.refresh_period * 100
+        self.view_range = PointOfView.VIEW_RANGE if view_range is None else view_range
+        lod = dict(PointOfView.RUNWAY_LOD)
+        if runway_lod is not None:
+            lod.update(runway_lod)
+        self.lod_thresholds = [tuple(lod[tier]) for tier in ('outline', 'labels', 'full')]
+        self.lod_hysteresis = lod['hysteresis']
+        # Directory of SRTM .hgt elevation tiles, if there is one
+        self.terrain = None if dem_path is None else ElevationTiles(dem_path)
+        if cache_budget is None:
+            cache_budget = PointOfView.CACHE_BUDGET
+        self.cache_budget = cache_budget * 1024 * 1024
 
         # Computed State
         self.view_screen = None
-        self.object_cache = dict()
+        # Loaded blocks, least recently used first. Only the blocks in
+        # window are displayed; the rest are kept, within cache_budget bytes,
+        # in case we fly back into them. Once a block's objects are moved
+        # into its BlockTable, all that is left here are the runway ends
+        # still waiting for their opposite end.
+        self.object_cache = collections.OrderedDict()
+        self.cache_bytes = dict()
+        self.window = list()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.block_tables = dict()
+        # All the block tables in window, joined into one for rendering
+        self.window_table = BlockTable([])
+        # Runway ends waiting for their opposite end, as (block, end) lists
+        # by runway_key
+        self.waiting_ends = dict()
+        # Runway ends taken out of one block to pair with a runway in another,
+        # by the block of the runway they were paired with
+        self.partners = dict()
+        self.runway_locator = NearestIndex([], [], [], 0)
+        self.airport_locator = NearestIndex([], [], [], 0)
+        self.airport_priorities = dict()
+        self.labels = OccupancyGrid()
         self.elevation = 0
         self.last_time = None
-        self.last_cache_time = None
         self.do_render = False
+        # Keys of the objects on display: (RUNWAY, name, airport id) or
+        # (point type, id)
+        self.rendered = set()
+        self.runway_lods = dict()
+        # Position the terrain mesh was sampled from, the mesh, and the
+        # screen position of its reference point when last projected
+        self.terrain_state = None
+        self.terrain_mesh = None
+        self.terrain_reference_point = None
+        self.terrain_band_cache = None
+        self.track = None
+        self.track_ref = None
+        self.motion = DeadReckoning()
+        self.tile_loader = TileLoader(dbpath, index_path, tile_callback, tilepath)
+        self.tile_loader.start()
+
+    def stop(self):
+        self.tile_loader.stop()
+        if self.terrain is not None:
+            self.terrain.close()
 
     def initialize(self, show_what, display_width, lng, lat, alt, head):
         self.display_width = display_width
@@ -542,6 +897,7 @@ class PointOfView:
     def update_position(self, lat, lng):
         self.gps_lat = lat
         self.gps_lng = lng
+        self.update_track()
         self.update_cache()
         self.elevation = self.approximate_elevation()
         self.update_screen()
@@ -549,12 +905,26 @@ class PointOfView:
     def update_altitude(self, alt):
         self.altitude = alt
 
+    def update(self, lat, lng, true_heading, alt, position_changed=True):
+        """ Apply a new position, heading and altitude all at once, with a
+            single view screen update.
+        """
+        self.altitude = alt
+        self.true_heading = true_heading
+        if position_changed:
+            self.gps_lat = lat
+            self.gps_lng = lng
+            self.update_track()
+            self.update_cache()
+            self.elevation = self.approximate_elevation()
+        self.update_screen(force=True)
+
     def update_heading(self, true_heading):
         self.true_heading = true_heading
         self.update_screen()
 
-    def update_screen(self):
-        if self.last_time is not None and \
+    def update_screen(self, force=False):
+        if (not force) and self.last_time is not None and \
                 (time.time() - self.last_time < self.refresh_period):
             return
         earth_radius = EARTH_RADIUS + self.elevation
@@ -617,137 +987,844 @@ class PointOfView:
         xvec.div(xvec.norm())
         yvec = view_vector.cross_product(xvec)
         self.view_screen = Spatial.Screen(viewplane, self.pov_position, xvec=xvec, yvec=yvec)
+        # Keep a NumPy copy of the view screen for batched projections
+        self.pov_array = point_array(self.pov_position)
+        self.view_normal = point_array(viewplane.normal)
+        self.view_c = viewplane.c
+        self.view_xdir = point_array(xvec)
+        self.view_ydir = point_array(yvec)
         self.last_time = time.time()
         self.do_render = True
         #print ("new view screen %s"%str(self.view_screen))
 
-    def update_cache(self):
-        if self.last_cache_time is not None and \
-                (time.time() - self.last_cache_time < self.cache_refresh_period):
+    def update_track(self):
+        """ Estimate the ground track from successive positions. Used to
+            decide which cache blocks to prefetch.
+        """
+        pos = (self.gps_lng, self.gps_lat)
+        if self.track_ref is None:
+            self.track_ref = pos
             return
-        center_lat = int(self.gps_lat)
-        center_lng = int(self.gps_lng)
-        for lat_inc in range(-1,2,1):
-            for lng_inc in range(-1,2,1):
-                block = (center_lat + lat_inc, center_lng + lng_inc)
-                if not block in self.object_cache:
-                    self.object_cache[block] = CIFPObjects.find_objects(
-                                    self.dbpath, self.index_path, block[0], block[1])
-                    #print ("New cache block has %d objects at %f,%f"%(len(self.object_cache[block]), self.gps_lat, self.gps_lng))
-        # Match runways
-        self.last_cache_time = time.time()
-        while True:
-            rwsearch = None
-            rwsearchblock = None
-            rwsearchnum = -1
-            rwdelete = -1
-            rwdeleteblock = None
-            for block,olist in self.object_cache.items():
-                for i,o in enumerate(olist):
-                    if isinstance(o, CIFPObjects.Runway) and (not o.matched()):
-                        if rwsearch is None:
-                            rwsearch = o
-                            rwsearchblock = block
-                            rwsearchnum = i
-                            #print ("Search match for %s"%str(o))
-                        else:
-                            if rwsearch.match(o):
-                                rwdelete = i
-                                rwdeleteblock = block
-                                rwsearch = None
-                                break
-                            else:
-                                #print ("Mis match for %s"%str(o))
-                                pass
-                if rwdeleteblock is not None:
-                    break
-            if rwdeleteblock is not None:
-                del self.object_cache[rwdeleteblock][rwdelete]
+        rel_lng = math.cos(self.gps_lat * RAD_DEG)
+        dlng = (pos[0] - self.track_ref[0]) * rel_lng
+        dlat = pos[1] - self.track_ref[1]
+        if dlng * dlng + dlat * dlat > .01 * .01:
+            self.track = math.atan2(dlng, dlat) * DEG_RAD
+            self.track_ref = pos
+
+    def update_cache(self):
+        """ Swap in cache blocks loaded by the tile loader thread. The blocks
+            surrounding the aircraft are swapped in together, once they are all
+            loaded, so the display never shows a half loaded window.
+        """
+        window = cache_window(*self.window_center())
+        changed_blocks = set()
+        new_ends = list()
+        missing = [block for block in window if block not in self.object_cache]
+        if len(missing) > 0:
+            loaded = self.tile_loader.take(missing)
+            if loaded is None:
+                for block in missing:
+                    self.tile_loader.request(block)
             else:
-                if rwsearch is None:
-                    break
-                else:
-                    log.debug ("Unable to find match for %s"%str(rwsearch))
-                    del self.object_cache[rwsearchblock][rwsearchnum]
-        self.garbage_collect_cache()
-
-
-    def garbage_collect_cache(self):
-        center_lat = int(self.gps_lat)
-        center_lng = int(self.gps_lng)
-        keeplist = list()
-        for lat_inc in range(-1,2,1):
-            for lng_inc in range(-1,2,1):
-                block = (center_lat + lat_inc, center_lng + lng_inc)
-                keeplist.append(block)
-        purge_list = list()
-        for cacheline in self.object_cache.keys():
-            if not cacheline in keeplist:
-                purge_list.append(cacheline)
-        for p in purge_list:
-            del self.object_cache[p]
+                for block,(runways,points) in loaded.items():
+                    taken = self.ends_taken(block)
+                    runways = [rw for rw in runways if (rw.airport_id, rw.name) not in taken]
+                    self.object_cache[block] = runways
+                    self.block_tables[block] = BlockTable([], self.terrain, points)
+                    self.cache_bytes[block] = PointOfView.BLOCK_OVERHEAD + \
+                            self.block_tables[block].nbytes() + block_bytes(runways)
+                    new_ends.extend((block, end) for end in runway_ends(runways))
+                changed_blocks.update(loaded.keys())
+                self.do_render = True
+        self.prefetch()
+        if len(missing) > 0 and len(changed_blocks) == 0:
+            # Keep showing the old window until the new one is complete
+            return
+        if window == self.window:
+            return
+        self.cache_hits += len(window) - len(missing)
+        self.cache_misses += len(missing)
+        self.window = window
+        for block in window:
+            self.object_cache.move_to_end(block)
+        changed_blocks.update(self.evict_blocks(new_ends))
+        self.match_runways(new_ends, changed_blocks)
+        for block in changed_blocks:
+            self.compact_block(block)
+        self.window_table = BlockTable([])
+        for block in window:
+            self.window_table.extend(self.block_tables[block])
+        self.build_locators()
+        self.do_render = True
+        log.debug ("Block cache: %d hits, %d misses, %d blocks, %.1f MB",
+                    self.cache_hits, self.cache_misses, len(self.object_cache),
+                    sum(self.cache_bytes.values()) / (1024.0 * 1024.0))
+
+    def window_center(self):
+        """ The block at the center of the displayed window. It only moves
+            once the aircraft is WINDOW_HYSTERESIS past the edge of the
+            current center block, so flying along a block edge doesn't keep
+            moving the window back and forth.
+        """
+        if len(self.window) > 0:
+            lat, lng = self.window[len(self.window) // 2]
+            h = PointOfView.WINDOW_HYSTERESIS
+            if lat in (int(self.gps_lat), int(self.gps_lat - h), int(self.gps_lat + h)) and \
+                    lng in (int(self.gps_lng), int(self.gps_lng - h), int(self.gps_lng + h)):
+                return lat, lng
+        return int(self.gps_lat), int(self.gps_lng)
+
+    def compact_block(self, block):
+        """ Move the paired runways of a block into its BlockTable. Only the
+            runway ends still waiting for their opposite end are kept as
+            objects, so that they can be paired with a block loaded later.
+        """
+        waiting = [rw for rw in self.object_cache[block] if not rw.matched()]
+        table = BlockTable(self.object_cache[block], self.terrain)
+        if block in self.block_tables:
+            self.block_tables[block].extend(table)
+        else:
+            self.block_tables[block] = table
+        self.object_cache[block] = waiting
+        self.cache_bytes[block] = PointOfView.BLOCK_OVERHEAD + \
+                self.block_tables[block].nbytes() + block_bytes(waiting)
+
+    def build_locators(self):
+        """ Index the runway ends and airports in the window by position """
+        table = self.window_table
+        waiting = [o for block in self.window for o in self.object_cache[block]]
+        self.runway_locator = NearestIndex(
+                    np.concatenate([table.runway_lats.ravel(), [o.lat for o in waiting]]),
+                    np.concatenate([table.runway_lngs.ravel(), [o.lng for o in waiting]]),
+                    np.concatenate([np.repeat(table.runway_elevations, 2),
+                                    [o.elevation for o in waiting]]).tolist(),
+                    self.gps_lat)
+        airports = table.point_types == AIRPORT
+        airport_ids = table.point_ids[airports].tolist()
+        self.airport_locator = NearestIndex(table.point_lats[airports],
+                    table.point_lngs[airports], airport_ids, self.gps_lat)
+
+        longest = dict()
+        for airport_id,length in zip(table.runway_airports.tolist() +
+                                        [o.airport_id for o in waiting],
+                                     table.runway_lengths.tolist() +
+                                        [o.length for o in waiting]):
+            longest[airport_id] = max(longest.get(airport_id, 0), length)
+        self.airport_priorities = {i:label_priority(longest.get(i, 0))
+                                   for i in airport_ids}
+
+    def nearest_runways(self, k=1):
+        """ Returns up to k (distance nm, runway elevation) tuples for the
+            runway ends nearest the aircraft
+        """
+        return self.runway_locator.nearest(self.gps_lat, self.gps_lng, k)
+
+    def nearest_airports(self, k=1):
+        """ Returns up to k (distance nm, airport id) tuples nearest the aircraft """
+        return self.airport_locator.nearest(self.gps_lat, self.gps_lng, k)
+
+
+    def match_runways(self, new_ends, changed_blocks):
+        """ Pair up the (block, end) runway ends in new_ends with the ends
+            waiting for them, with one lookup each. The waiting ends that are
+            paired keep a reference to their opposite end, which is removed
+            from the cache. Ends still unpaired wait in case their opposite
+            end arrives with a later block.
+            Blocks whose objects changed are added to changed_blocks.
+        """
+        removed = dict()
+        for block, end in new_ends:
+            if block not in self.object_cache:
+                continue        # Evicted since
+            key = runway_key(end)
+            rkey = reciprocal_runway_key(key)
+            waiting = self.waiting_ends.get(rkey)
+            if waiting is None:
+                self.waiting_ends.setdefault(key, list()).append((block, end))
+                continue
+            # The end that was waiting holds the pair
+            pblock, partner = waiting.pop(0)
+            if len(waiting) == 0:
+                del self.waiting_ends[rkey]
+            partner.set_opposing_runway(end)
+            removed.setdefault(block, set()).add(id(end))
+            self.partners.setdefault(pblock, list()).append((block, end))
+            changed_blocks.add(block)
+            changed_blocks.add(pblock)
+        for block,ids in removed.items():
+            self.object_cache[block] = [o for o in self.object_cache[block] if id(o) not in ids]
+
+    def prefetch(self):
+        """ Ask the tile loader for the blocks we are heading into """
+        track = self.true_heading if self.track is None else self.track
+        ahead_lng, ahead_lat = AddPosition ((self.gps_lng, self.gps_lat),
+                                            PointOfView.PREFETCH_DISTANCE, track)
+        for block in cache_window(ahead_lat, ahead_lng):
+            if block not in self.object_cache:
+                self.tile_loader.request(block, TileLoader.PREFETCH)
+
+    def evict_blocks(self, new_ends):
+        """ Drop least recently used blocks outside the window until the
+            cache fits its budget. Runway ends that a dropped block took from
+            blocks still in the cache are put back, and added to new_ends, so
+            they can pair again when the dropped block is reloaded. Ends that a block still in the
+            cache took from a dropped block stay drawn from there, and are
+            left out when the dropped block is reloaded.
+            Returns the blocks put back into.
+        """
+        restored = set()
+        total = sum(self.cache_bytes.values())
+        for block in list(self.object_cache.keys()):
+            if total <= self.cache_budget:
+                break
+            if block in self.window:
+                continue
+            total -= self.cache_bytes.pop(block)
+            for end in runway_ends(self.object_cache.pop(block)):
+                self.forget_waiting(block, end)
+            self.block_tables.pop(block, None)
+            restored.discard(block)
+            for pblock, partner in self.partners.pop(block, ()):
+                if pblock in self.object_cache:
+                    partner.set_opposing_runway(None)
+                    self.object_cache[pblock].append(partner)
+                    new_ends.append((pblock, partner))
+                    restored.add(pblock)
+        return restored
+
+    def forget_waiting(self, block, end):
+        """ Stop end of block waiting for its opposite end """
+        key = runway_key(end)
+        waiting = [w for w in self.waiting_ends.get(key, ()) if w[1] is not end]
+        if len(waiting) > 0:
+            self.waiting_ends[key] = waiting
+        else:
+            self.waiting_ends.pop(key, None)
+
+    def ends_taken(self, block):
+        """ Runway ends of block, as (airport id, name), that are drawn in
+            pairs held by other blocks
+        """
+        return set([(partner.airport_id, partner.name)
+                    for pairs in self.partners.values()
+                    for pblock, partner in pairs if pblock == block])
 
     def approximate_elevation(self):
-        """ Find the approximate elevation of the land beneath the aircraft by
-            finding the elevation of the nearest runway
+        """ Find the elevation of the land beneath the aircraft from the
+            terrain data, or else approximate it by the elevation of the
+            nearest runway
         """
-        NOMIN = 99999999
-        min_distance = NOMIN
-        elevation = 0
-        rel_lng = 0
-        curpos = (self.gps_lng,self.gps_lat)
-        for object_list in self.object_cache.values():
-            for obj in object_list:
-                if isinstance(obj, CIFPObjects.Runway):
-                    course = [curpos, (obj.lng,obj.lat)]
-                    distance, rel_lng = \
-                            Distance(course, rel_lng=rel_lng)
-                    if distance < min_distance:
-                        min_distance = distance
-                        elevation = obj.elevation
-        return elevation
+        if self.terrain is not None:
+            elevation = self.terrain.elevation(self.gps_lat, self.gps_lng)
+            if elevation is not None:
+                return elevation
+        nearest = self.nearest_runways(1)
+        if len(nearest) == 0:
+            return 0
+        return float(nearest[0][1])
 
     def render(self, display_object):
         if not self.do_render:
             return
-        sorted_objects = list()
-        for oblist in self.object_cache.values():
-            for ob in oblist:
-                if ob.typestr() in self.show_object_types:
-                    if ob.typestr() in self.sorted_object_types:
-                        sorted_objects.append (ob)
-                    else:
-                        ob.render (self, display_object, self.display_width,
-                                    (self.gps_lng, self.gps_lat))
-        rel_lng = GetRelLng(self.gps_lat)
-        sorted_objects = [(Distance( [(self.gps_lng, self.gps_lat), (so.lng,so.lat)],
-                                    rel_lng)[0], so) for so in sorted_objects]
-        sorted_objects.sort()
-        space_occupied = list()
-        for d,so in sorted_objects:
-            rect = so.render (self, display_object, self.display_width,
-                                    (self.gps_lng, self.gps_lat), space_occupied)
-            if rect is not None:
-                space_occupied.append(rect)
-
+        if "Terrain" in self.show_object_types and self.terrain is not None:
+            display_object.render_terrain (*self.terrain_bands())
+        radius = self.object_radius()
+        max_distance = self.max_view_distance()
+        table = self.window_table
+        points = list()
+        rendered = set()
+        if "Runway" in self.show_object_types and len(table.runway_names) > 0:
+            candidates = self.view_candidates (table.runway_lats, table.runway_lngs,
+                                               max_distance).any(axis=1)
+            candidates = np.flatnonzero(candidates)
+            if len(candidates) > 0:
+                rendered.update(self.render_runways (display_object, table, candidates, radius))
+        # Lookup table of which point types are shown, indexed by type
+        shown = np.zeros(max(PointOfView.POINT_TYPES.values()) + 1, dtype=bool)
+        for name,ptype in PointOfView.POINT_TYPES.items():
+            shown[ptype] = name in self.show_object_types
+        candidates = np.flatnonzero(shown[table.point_types] &
+                self.view_candidates (table.point_lats, table.point_lngs, max_distance))
+        if len(candidates) > 0:
+            xs, ys, visible = self.project (table.point_positions(radius)[candidates])
+            rel_lng = math.cos(self.gps_lat * RAD_DEG)
+            distances = np.hypot((table.point_lngs[candidates] - self.gps_lng) * rel_lng,
+                                 table.point_lats[candidates] - self.gps_lat) * 60.0
+            for j,(ptype,ident,name) in enumerate(zip(table.point_types[candidates].tolist(),
+                                                     table.point_ids[candidates].tolist(),
+                                                     table.point_names[candidates].tolist())):
+                key = (ptype, ident)
+                rendered.add(key)
+                point = (xs[j], ys[j]) if visible[j] else None
+                points.append ((self.placement_priority(key), distances[j], key, name, point))
+        # Labels are placed highest priority first, nearest first within a
+        # priority. Anything that would overlap a label already placed is left
+        # off the display.
+        points.sort(key=lambda p: p[:2])
+        self.labels.clear()
+        for priority,d,key,name,point in points:
+            self.render_point (display_object, key, name, point, self.labels)
+
+        # Remove whatever left the view since the last render
+        for key in self.rendered - rendered:
+            self.eliminate (display_object, key)
+            self.runway_lods.pop(key, None)
+        self.rendered = rendered
         self.do_render = False
 
+    def terrain_bands(self):
+        """ The terrain ahead as TERRAIN_BANDS silhouettes, farthest first.
+            Returns (bands, offset, rebuilt). Each band is an (xs, ys) pair of
+            arrays giving the top edge of that band on the view screen; the
+            band is filled from there down. The mesh is only resampled after
+            a large enough turn, move or climb. Until then rebuilt is False and
+            offset is how far the last bands have shifted on the screen.
+        """
+        state = self.terrain_state
+        if state is not None:
+            lat, lng, heading, altitude, zoom, width = state
+            turn = abs((self.true_heading - heading + 180.0) % 360.0 - 180.0)
+            moved = Distance([(lng,lat), (self.gps_lng,self.gps_lat)])[0]
+        if state is None or zoom != self.zoom or width != self.display_width or \
+                turn >= PointOfView.TERRAIN_TURN or moved >= PointOfView.TERRAIN_MOVE or \
+                abs(self.altitude - altitude) >= PointOfView.TERRAIN_CLIMB:
+            self.terrain_state = (self.gps_lat, self.gps_lng, self.true_heading,
+                                  self.altitude, self.zoom, self.display_width)
+            self.terrain_mesh = self.sample_terrain()
+            rebuilt = True
+        else:
+            rebuilt = False
+        positions, reference = self.terrain_mesh
+        if rebuilt:
+            xs, ys, visible = self.project (positions)
+            shape = (PointOfView.TERRAIN_RINGS, PointOfView.TERRAIN_COLUMNS)
+            xs = xs.reshape(shape)
+            ys = np.where(visible, ys, self.display_width).reshape(shape)
+            rxs, rys, _ = self.project (reference)
+            self.terrain_reference_point = (rxs[0], rys[0])
+            bands = list()
+            for rings in np.array_split(np.arange(shape[0]), PointOfView.TERRAIN_BANDS):
+                # The top edge of a band is the highest point of any of its
+                # rings in each column
+                bands.append ((xs[rings[0]], ys[rings].min(axis=0)))
+            self.terrain_band_cache = bands
+            return bands, (0, 0), True
+        rxs, rys, _ = self.project (reference)
+        offset = (rxs[0] - self.terrain_reference_point[0],
+                  rys[0] - self.terrain_reference_point[1])
+        return self.terrain_band_cache, offset, False
+
+    def sample_terrain(self):
+        """ Sample elevations on a grid of rings, farthest first, across the
+            view cone. Farther rings read coarser levels of the elevation
+            tiles. Returns earth centered positions of the grid points, and of
+            a reference point straight ahead on the farthest ring.
+        """
+        max_distance = self.max_view_distance()
+        half_angle = math.atan(math.tan(VIEWPORT_ANGLE100) * 100.0 / self.zoom) * DEG_RAD \
+                        + PointOfView.CULL_MARGIN
+        distances = np.geomspace(max_distance, PointOfView.TERRAIN_NEAR,
+                                 PointOfView.TERRAIN_RINGS)
+        bearings = (self.true_heading + np.linspace(-half_angle, half_angle,
+                                    PointOfView.TERRAIN_COLUMNS)) * RAD_DEG
+        rel_lng = math.cos(self.gps_lat * RAD_DEG)
+        lats = self.gps_lat + np.outer(distances, np.cos(bearings)) / 60.0
+        lngs = self.gps_lng + np.outer(distances, np.sin(bearings)) / (60.0 * rel_lng)
+        # Sample spacing across a ring, in degrees
+        spacing = distances * (2 * half_angle * RAD_DEG / PointOfView.TERRAIN_COLUMNS) / 60.0
+        heights = self.terrain.elevations(lats, lngs, spacing=spacing[:,np.newaxis])
+        positions = polar_to_cartesian (lats.ravel(), lngs.ravel(), 1.0)
+        positions *= (EARTH_RADIUS + heights.ravel())[:,np.newaxis]
+        center = PointOfView.TERRAIN_COLUMNS // 2
+        reference = positions[center:center+1].copy()
+        return positions, reference
+
+    def object_radius(self):
+        """ Radius the cached object positions are scaled from. With terrain
+            data every object carries its own elevation; without it they're
+            all drawn at the elevation beneath the aircraft.
+        """
+        if self.terrain is not None:
+            return EARTH_RADIUS
+        return EARTH_RADIUS + self.elevation
+
+    def max_view_distance(self):
+        """ Objects farther away than this, in nautical miles, are not rendered.
+            That is the configured view range, or the horizon if it's closer.
+        """
+        earth_radius = EARTH_RADIUS + self.elevation
+        pov_radius = max(EARTH_RADIUS + self.altitude, earth_radius + 10)
+        horizon = math.sqrt(pov_radius * pov_radius - earth_radius * earth_radius) * NM_FEET
+        return min(horizon, self.view_range)
+
+    def view_candidates(self, lats, lngs, max_distance):
+        """ Cheap culling pass ahead of projection. Returns a mask of which of
+            the given positions are within max_distance and inside the
+            heading relative view cone.
+        """
+        rel_lng = math.cos(self.gps_lat * RAD_DEG)
+        dx = (lngs - self.gps_lng) * rel_lng
+        dy = lats - self.gps_lat
+        distance = np.hypot(dx, dy) * 60.0
+        bearing = np.arctan2(dx, dy) * DEG_RAD
+        relative_bearing = np.abs((bearing - self.true_heading + 180.0) % 360.0 - 180.0)
+        half_angle = math.atan(math.tan(VIEWPORT_ANGLE100) * 100.0 / self.zoom) * DEG_RAD
+        return (distance <= max_distance) & \
+                ((relative_bearing <= half_angle + PointOfView.CULL_MARGIN) |
+                 (distance <= PointOfView.CULL_NEAR))
+
+    def placement_priority(self, key):
+        """ Lower numbers are placed first """
+        ptype, ident = key
+        if ptype == AIRPORT:
+            return self.airport_priorities.get(ident, len(PointOfView.AIRPORT_PRIORITY))
+        return PointOfView.NAVAID_PRIORITY
+
+    def eliminate(self, display_object, key):
+        if key[0] == RUNWAY:
+            display_object.eliminate_runway (key[1], key[2])
+        elif key[0] == AIRPORT:
+            display_object.eliminate_airport (key[1])
+        elif key[0] == NAVAID:
+            display_object.eliminate_navaid (key[1])
+
+    def render_point(self, display_object, key, name, point, labels):
+        """ Render an object drawn at a single projected point, such as an
+            airport or navaid. point is None if the object is behind the viewer.
+            labels is the OccupancyGrid of labels already placed this frame.
+        """
+        dw2 = self.display_width / 2
+        if point is not None:
+            px,py = point
+            if px < -dw2 or px > dw2 or py < 0 or py > dw2:
+                point = None
+        ptype, ident = key
+        if ptype == AIRPORT:
+            if point is None:
+                display_object.eliminate_airport (ident)
+            else:
+                display_object.render_airport (point, name, ident,
+                                               self.zoom, labels)
+        elif ptype == NAVAID:
+            if point is None:
+                display_object.eliminate_navaid (ident)
+            else:
+                display_object.render_navaid (point, ident, labels)
+
+    def render_runways(self, display_object, table, rows, radius):
+        """ Render the given rows of the runways in a BlockTable. Every point
+            is projected onto the view screen in a single batch.
+            Returns the keys of the runways.
+        """
+        positions = table.runway_positions(radius)[rows]
+        shape = positions.shape[:2]
+        xs, ys, visible = self.project (positions.reshape(-1,3))
+        xs = xs.reshape(shape)
+        ys = ys.reshape(shape)
+        visible = visible.reshape(shape)
+        dw2 = self.display_width / 2
+        in_clip = (xs >= -dw2) & (xs <= dw2) & (ys >= 0) & (ys <= dw2)
+        on_screen = (xs >= -self.display_width) & (xs <= self.display_width) & \
+                    (ys >= -self.display_width) & (ys <= self.display_width)
+        corner_ys = ys[:,2:]
+        renderable = visible.all(axis=1) & on_screen[:,:2].all(axis=1) & \
+                     in_clip[:,:2].any(axis=1) & \
+                     (corner_ys.max(axis=1) - corner_ys.min(axis=1) >= RENDER_HEIGHT_THRESHOLD)
+
+        corner_xs = xs[:,2:]
+        sizes = np.maximum(corner_xs.max(axis=1) - corner_xs.min(axis=1),
+                           corner_ys.max(axis=1) - corner_ys.min(axis=1))
+
+        # Distance to the nearer end, for the PAPI lights and level of detail
+        rel_lng = math.cos(self.gps_lat * RAD_DEG)
+        distances = np.hypot((table.runway_lngs[rows] - self.gps_lng) * rel_lng,
+                             table.runway_lats[rows] - self.gps_lat).min(axis=1) * 60.0
+        keys = list()
+        for i,(name,airport_id,elevation,length,bearing) in enumerate(zip(
+                    table.runway_names[rows].tolist(),
+                    table.runway_airports[rows].tolist(),
+                    table.runway_elevations[rows].tolist(),
+                    table.runway_lengths[rows].tolist(),
+                    table.runway_bearings[rows].tolist())):
+            key = (RUNWAY, name, airport_id)
+            keys.append(key)
+            if not renderable[i]:
+                display_object.eliminate_runway (name, airport_id)
+                self.runway_lods.pop(key, None)
+                continue
+            lod = self.runway_lod (key, sizes[i], distances[i])
+            p11, p12, p21, p22 = [(xs[i,j], ys[i,j]) for j in range(2,6)]
+            display_object.render_runway (p12, p11, p21, p22, distances[i] * FEET_NM,
+                    elevation, length, bearing, name, airport_id, self.zoom, lod)
+        return keys
+
+    def runway_lod(self, key, size, distance):
+        """ Choose the level of detail for a runway size pixels across and
+            distance nautical miles away: the highest tier whose thresholds
+            it meets, if it meets the outline's. The tier it's already at is
+            held until it is clearly out of range, so it doesn't flicker.
+        """
+        current = self.runway_lods.get(key, LOD_DOT)
+        held = 1.0 - self.lod_hysteresis
+        lod = LOD_DOT
+        for tier,(min_size, max_distance) in enumerate(self.lod_thresholds, LOD_DOT + 1):
+            if tier <= current:
+                fits = size >= min_size * held and distance * held <= max_distance
+            else:
+                fits = size >= min_size and distance <= max_distance
+            if fits:
+                lod = tier
+            elif tier == LOD_OUTLINE:
+                break
+        self.runway_lods[key] = lod
+        return lod
+
     def point2D (self, lat, lng, debug=False):
         """ Find the projected point on the view screen given a latitude and longitude
             of the point.
         """
-        point_radius = EARTH_RADIUS + self.elevation
-        point_polar = Spatial.Polar (lng * RAD_DEG, lat * RAD_DEG, point_radius)
-        point_position = point_polar.to3()
-        r = Spatial.Ray(self.pov_position, pos2=point_position)
-        try:
-            p = self.view_screen.point2D (r)
-        except:
-            p = None
+        if self.view_screen is None:
+            return None
+        xs, ys, visible = self.points2D (np.array([lat]), np.array([lng]))
+        p = (float(xs[0]), float(ys[0])) if visible[0] else None
         if debug:
-            log.debug ("point2D %s->%s ==> %s ==> %s"%(str(self.pov_position), str(point_position), str(r), str(p)))
+            log.debug ("point2D %f,%f ==> %s"%(lat, lng, str(p)))
         return p
 
+    def points2D (self, lats, lngs):
+        """ Batched version of point2D. Takes arrays of latitudes and longitudes
+            and returns arrays of screen x, y and a mask of which points are
+            in front of the viewer.
+        """
+        point_radius = EARTH_RADIUS + self.elevation
+        return self.project (polar_to_cartesian (lats, lngs, point_radius))
+
+    def project (self, positions):
+        """ Project an (N,3) array of earth centered positions onto the view screen.
+            Returns (xs, ys, visible).
+        """
+        rays = positions - self.pov_array
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (self.view_c - np.dot(self.view_normal, self.pov_array)) / \
+                    np.dot(rays, self.view_normal)
+        visible = np.isfinite(t) & (t >= 0)
+        rays *= np.where(visible, t, 0)[:,np.newaxis]
+        return np.dot(rays, self.view_xdir), np.dot(rays, self.view_ydir), visible
+
+def point_array(p):
+    return np.array([p.x, p.y, p.z])
+
+def polar_to_cartesian(lats, lngs, radius):
+    """ Vectorized Spatial.Polar(lng, lat, radius).to3() for arrays of
+        latitudes and longitudes in degrees. Returns an (N,3) array.
+    """
+    theta = np.asarray(lngs, dtype=float) * RAD_DEG
+    phi = np.asarray(lats, dtype=float) * RAD_DEG
+    cos_phi = np.cos(phi)
+    ret = np.empty((len(theta),3))
+    ret[:,0] = np.cos(theta) * cos_phi
+    ret[:,1] = np.sin(theta) * cos_phi
+    ret[:,2] = np.sin(phi)
+    ret *= radius
+    return ret
+
+class DeadReckoning:
+    """ Motion model used to move the point of view smoothly between GPS
+        fixes, which come in much slower than the display rate.
+        Position is extrapolated from the last fix along the track at ground
+        speed, and altitude from the last sample at vertical speed. When a new
+        fix disagrees with the prediction, the difference is blended out over
+        BLEND_TIME instead of jumping.
+        Each prediction costs a constant handful of arithmetic operations,
+        no matter how many objects are displayed.
+    """
+    MAX_EXTRAPOLATION = 2.0     # Seconds. Stop extrapolating stale data
+    BLEND_TIME = .5             # Seconds
+    MIN_GROUND_SPEED = 1.0      # Knots
+    def __init__(self):
+        self.fix_time = None
+        self.lat = 0
+        self.lng = 0
+        self.gs = 0
+        self.track = 0
+        self.error = (0, 0)
+        self.alt_time = None
+        self.alt = 0
+        self.vs = 0
+        self.alt_error = 0
+
+    def position_fix(self, lat, lng, gs, track, now):
+        if self.moving(now):
+            plat, plng = self.predict(now)
+            self.error = (plat - lat, plng - lng)
+        else:
+            self.error = (0, 0)
+        self.fix_time = now
+        self.lat = lat
+        self.lng = lng
+        self.gs = gs
+        self.track = track
+
+    def altitude_fix(self, alt, vs, now):
+        if self.alt_time is not None and now - self.alt_time < DeadReckoning.MAX_EXTRAPOLATION:
+            self.alt_error = self.predict_altitude(now, alt) - alt
+        else:
+            self.alt_error = 0
+        self.alt_time = now
+        self.alt = alt
+        self.vs = vs
+
+    def moving(self, now):
+        return self.fix_time is not None and self.gs >= DeadReckoning.MIN_GROUND_SPEED and \
+                now - self.fix_time < DeadReckoning.MAX_EXTRAPOLATION
+
+    def blend(self, elapsed):
+        return max(0.0, 1.0 - elapsed / DeadReckoning.BLEND_TIME)
+
+    def predict_altitude(self, now, default):
+        """ Returns the predicted altitude at time now, or default if there
+            haven't been any altitude samples yet.
+        """
+        if self.alt_time is None:
+            return default
+        elapsed = min(now - self.alt_time, DeadReckoning.MAX_EXTRAPOLATION)
+        return self.alt + self.vs * elapsed / 60.0 + self.alt_error * self.blend(elapsed)
+
+    def predict(self, now):
+        """ Returns the predicted (lat, lng) at time now """
+        elapsed = min(now - self.fix_time, DeadReckoning.MAX_EXTRAPOLATION)
+        lng, lat = AddPosition ((self.lng, self.lat), self.gs * elapsed / 3600.0, self.track)
+        blend = self.blend(elapsed)
+        return (lat + self.error[0] * blend, lng + self.error[1] * blend)
+
+def label_priority(longest_runway):
+    """ Placement priority of an airport label, by its longest runway """
+    for i,length in enumerate(PointOfView.AIRPORT_PRIORITY):
+        if longest_runway >= length:
+            return i
+    return len(PointOfView.AIRPORT_PRIORITY)
+
+def block_bytes(objects):
+    """ Rough memory used by a list of objects and their attributes """
+    total = 0
+    for o in objects:
+        attributes = vars(o)
+        total += sys.getsizeof(o) + sys.getsizeof(attributes)
+        total += sum([sys.getsizeof(v) for v in attributes.values()])
+    return total
+
+def cache_window(lat, lng):
+    """ The list of cache blocks surrounding a position """
+    center_lat = int(lat)
+    center_lng = int(lng)
+    return [(center_lat + lat_inc, center_lng + lng_inc)
+                for lat_inc in range(-1,2,1) for lng_inc in range(-1,2,1)]
+
+RECIPROCAL_SUFFIX = {"L":"R", "C":"C", "R":"L", "W":"W", "":""}
+
+def runway_key(rw):
+    """ Key a runway end by airport, runway number and parallel runway suffix """
+    number = ''.join([d for d in rw.name if d >= '0' and d <= '9'])
+    if len(number) == 0:
+        return None
+    suffix = rw.name[-1] if rw.name[-1] in RECIPROCAL_SUFFIX else ""
+    return (rw.airport_id, int(number), suffix)
+
+def reciprocal_runway_key(key):
+    airport_id, number, suffix = key
+    number += 18
+    if number > 36:
+        number -= 36
+    return (airport_id, number, RECIPROCAL_SUFFIX[suffix])
+
+def runway_ends(objects):
+    """ The unmatched runway ends in objects that can be paired by runway_key """
+    return [o for o in objects if isinstance(o, CIFPObjects.Runway) and
+            not o.matched() and runway_key(o) is not None]
+
+class TileLoader(threading.Thread):
+    """ Loads cache blocks from the CIFP database in the background, so that
+        parsing the database never stalls the GUI thread. Blocks needed for
+        the current position are loaded before prefetched ones.
+    """
+    NEEDED = 0
+    PREFETCH = 1
+    MAX_READY = 27
+    def __init__(self, dbpath, index_path, callback=None, tilepath=None):
+        super(TileLoader, self).__init__(name="TileLoader", daemon=True)
+        self.dbpath = dbpath
+        self.index_path = index_path
+        self.tile_store = None
+        if tilepath is not None:
+            try:
+                self.tile_store = TileStore(tilepath)
+            except Exception as e:
+                log.warning ("Unable to open tile store %s, parsing %s instead: %s",
+                                tilepath, dbpath, str(e))
+        self.callback = callback
+        self.requests = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.pending = dict()
+        self.ready = collections.OrderedDict()
+
+    def request(self, block, priority=NEEDED):
+        with self.lock:
+            if block in self.ready or self.pending.get(block, priority + 1) <= priority:
+                return
+            self.pending[block] = priority
+        self.requests.put ((priority, next(self.sequence), block))
+
+    def take(self, blocks):
+        """ Atomically remove and return the loaded objects for all the given
+            blocks, as a dictionary. Returns None if any of them is not loaded yet.
+        """
+        with self.lock:
+            if not all(block in self.ready for block in blocks):
+                return None
+            return {block:self.ready.pop(block) for block in blocks}
+
+    def run(self):
+        while True:
+            priority, _, block = self.requests.get()
+            if block is None:
+                break
+            with self.lock:
+                if self.pending.get(block) != priority:
+                    continue    # Already loaded by a higher priority request
+            try:
+                objects = self.load(block)
+            except Exception as e:
+                # Show the block empty rather than wait for it forever
+                log.error ("Unable to load block %s: %s", str(block), str(e))
+                objects = ([], np.zeros(0, dtype=RECORD))
+            with self.lock:
+                del self.pending[block]
+                self.ready[block] = objects
+                while len(self.ready) > TileLoader.MAX_READY:
+                    self.ready.popitem(last=False)
+            if self.callback is not None:
+                self.callback()
+
+    def load(self, block):
+        """ The runway ends of a block as objects, and its airports and
+            navaids as TileStore records
+        """
+        if self.tile_store is not None:
+            return self.tile_store.find_block(block[0], block[1])
+        objects = CIFPObjects.find_objects(
+                        self.dbpath, self.index_path, block[0], block[1])
+        return ([o for o in objects if isinstance(o, CIFPObjects.Runway)],
+                point_records(objects))
+
+    def stop(self):
+        self.requests.put ((-1, -1, None))
+
+class BlockTable:
+    """ The objects of one cache block as parallel NumPy arrays, one set per
+        type, so that render passes can pick objects out with masks instead
+        of looking at each one. Runways are the matched ones among runways,
+        a row per pair of ends. Airports and navaids come in as an array of
+        TileStore records and share the point arrays, told apart by
+        point_types, which holds the TileStore type codes.
+        Positions are also stored as earth centered unit vectors so that no
+        trig is needed to project them. Scaled positions are kept until the
+        elevation reference changes.
+    """
+    FIELDS = ('runway_names', 'runway_airports', 'runway_elevations',
+              'runway_bearings', 'runway_lengths', 'runway_lats', 'runway_lngs',
+              'runway_units', 'runway_heights',
+              'point_types', 'point_ids', 'point_names', 'point_lats',
+              'point_lngs', 'point_units', 'point_heights')
+    def __init__(self, runways, terrain=None, points=None):
+        runways = [rw for rw in runways if rw.matched()]
+        if points is None:
+            points = np.zeros(0, dtype=RECORD)
+        self.runway_names = np.array([rw.name for rw in runways], dtype=str)
+        self.runway_airports = np.array([rw.airport_id for rw in runways], dtype=str)
+        self.runway_elevations = np.array([rw.elevation for rw in runways], dtype=float)
+        self.runway_bearings = np.array([rw.bearing for rw in runways], dtype=float)
+        self.runway_lengths = np.array([rw.length for rw in runways], dtype=float)
+        lats, lngs = runway_points ([rw.lat for rw in runways],
+                                    [rw.lng for rw in runways],
+                                    [rw.opposing_rw.lat for rw in runways],
+                                    [rw.opposing_rw.lng for rw in runways],
+                                    self.runway_bearings, self.runway_lengths)
+        self.runway_units = polar_to_cartesian (lats.ravel(), lngs.ravel(), 1.0).reshape(-1,6,3)
+        # Runway ends in degrees, for view culling
+        self.runway_lats = lats[:,:2].copy()
+        self.runway_lngs = lngs[:,:2].copy()
+
+        self.point_types = points['type'].copy()
+        self.point_ids = np.char.decode(points['id'])
+        self.point_names = np.char.decode(points['name'])
+        self.point_lats = points['lat'].astype(float)
+        self.point_lngs = points['lng'].astype(float)
+        self.point_units = polar_to_cartesian (self.point_lats, self.point_lngs, 1.0)
+        # Height of each object above the radius it's scaled from
+        if terrain is None:
+            self.runway_heights = np.zeros((len(runways),1,1))
+            self.point_heights = np.zeros((len(points),1))
+        else:
+            self.runway_heights = self.runway_elevations.reshape(-1,1,1)
+            self.point_heights = terrain.elevations(self.point_lats,
+                                                    self.point_lngs).reshape(-1,1)
+        self.radius = None
+        self._runway_positions = None
+        self._point_positions = None
+
+    def extend(self, other):
+        """ Append the rows of another table """
+        for field in BlockTable.FIELDS:
+            setattr(self, field, np.concatenate([getattr(self, field), getattr(other, field)]))
+        self.radius = None
+
+    def nbytes(self):
+        """ Memory used by the arrays """
+        return sum([getattr(self, field).nbytes for field in BlockTable.FIELDS])
+
+    def rescale(self, radius):
+        if radius != self.radius:
+            self.radius = radius
+            self._runway_positions = self.runway_units * (radius + self.runway_heights)
+            self._point_positions = self.point_units * (radius + self.point_heights)
+
+    def runway_positions(self, radius):
+        self.rescale (radius)
+        return self._runway_positions
+
+    def point_positions(self, radius):
+        self.rescale (radius)
+        return self._point_positions
+
+RENDER_HEIGHT_THRESHOLD = 1.0
+RUNWAY_WIDTH_RATIO = 100.0 / 5000.0
+
+def runway_points(lats, lngs, opp_lats, opp_lngs, bearings, lengths):
+    """ Compute the geographic points needed to draw runways.
+        Returns (lats, lngs) arrays of shape (N,6): the two runway ends followed
+        by the corners p11, p12, p21, p22.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lngs = np.asarray(lngs, dtype=float)
+    opp_lats = np.asarray(opp_lats, dtype=float)
+    opp_lngs = np.asarray(opp_lngs, dtype=float)
+    width_2_nm = np.asarray(lengths, dtype=float) * (RUNWAY_WIDTH_RATIO / 2 * NM_FEET)
+    brad = np.asarray(bearings, dtype=float) * RAD_DEG
+    # AddPosition for a bearing of +-90 degrees from the runway heading
+    dlat = width_2_nm * -np.sin(brad) / 60.0
+    dlng = width_2_nm * np.cos(brad) / 60.0
+    rel_lng = np.cos(lats * RAD_DEG)
+    opp_rel_lng = np.cos(opp_lats * RAD_DEG)
+    ret_lats = np.stack([lats, opp_lats,
+                         lats + dlat, lats - dlat,
+                         opp_lats + dlat, opp_lats - dlat], axis=1)
+    ret_lngs = np.stack([lngs, opp_lngs,
+                         lngs + dlng / rel_lng, lngs - dlng / rel_lng,
+                         opp_lngs + dlng / opp_rel_lng, opp_lngs - dlng / opp_rel_lng], axis=1)
+    return ret_lats, ret_lngs
+
 def yvec_points_east (yvec, pov_position, pov_polar):
     yvec_pos = copy.copy(yvec)
     yvec_pos.mult(10000)
@@ -792,6 +1869,13 @@ def F(var, function):
     else:
         return slope * var + intercept
 
+def AddPosition(position, distance, direction):
+    rel_lng = GetRelLng(position[1] * RAD_DEG)
+    direction *= RAD_DEG
+    dlat = distance * math.cos(direction) / 60.0
+    dlng = distance * math.sin(direction) / (rel_lng * 60.0)
+    return (position[0] + dlng, position[1] + dlat)
+
 def get_polar_deltas(course):
     lng1,lat1 = course[0]
     lng2,lat2 = course[1]
@@ -31,6 +31,7 @@ import pyavtools.fix as fix
 log = logging.getLogger(__name__)
 
 class AI(QGraphicsView):
+    TAS_BUCKET = 2      # Knots of true airspeed change that move the standard rate marks
     def __init__(self, parent=None):
         super(AI, self).__init__(parent)
         self.myparent = parent
@@ -64,22 +65,47 @@ class AI(QGraphicsView):
         self.fdpitchdb = fix.db.get_item("FDPITCH", wait=False, create=True)
         self.fdondb = fix.db.get_item("FDON", wait=False, create=True)
         self.fdondb.valueChanged[bool].connect(self.fdon)
-        self.fdtarget_widget = None
-        self.fdt = None
+        self.fdrolldb.valueChanged[float].connect(self.setFDAngle)
+        self.fdpitchdb.valueChanged[float].connect(self.setFDAngle)
+        self.fdtarget = None
         self.fix_tas = fix.db.get_item("TAS")
+        self.background_item = None
+        self.ladder_item = None
+        # The cached pixmaps are scaled and rotated fast while the roll is
+        # changing, and smoothly once it holds still for a frame
+        self.rolling = False
+        self.drawn_roll = None
+        self.overlay = None
+        self.overlay_tas = None
+
+        # Pitch, roll and flight director samples are latched as they arrive
+        # and applied together once per tick of the frame clock
+        self.frame_timer = QTimer(self)
+        self.frame_timer.timeout.connect(self.frame)
+        # Set when a compositor drives the frame clock and puts the frames
+        # on the screen
+        self.composited = False
+        # Arrival time of the oldest sample not yet applied, and of the
+        # oldest one applied but not yet painted
+        self.sample_time = None
+        self.applied_time = None
+        # Seconds from a sample arriving to it being painted, since the
+        # last report
+        self.latency_samples = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_report_time = time.time()
 
     def fdon(self, v):
         if v and self.isVisible():
-            if self.fdtarget_widget is None:
-                self.fdtarget_widget = FDTarget(QPointF(self.scene.width()/2, self.scene.height()/2), self.pixelsPerDeg)
-
-                self.fdtarget_widget.resize (120, 120)
-                self.fdt = self.scene.addWidget (self.fdtarget_widget)
+            if self.fdtarget is None:
+                self.fdtarget = FDTarget(QPointF(self.scene.width()/2, self.scene.height()/2), self.pixelsPerDeg)
+                self.scene.addItem (self.fdtarget)
+                self.fdtarget.setTarget (self.fdpitchdb.value, self.fdrolldb.value)
         else:
-            if self.fdt is not None:
-                self.scene.removeItem(self.fdt)
-                self.fdt = None
-                self.fdtarget_widget = None
+            if self.fdtarget is not None:
+                self.scene.removeItem(self.fdtarget)
+                self.fdtarget = None
 
     def resizeEvent(self, event):
         #Setup the scene that we use for the background of the AI
@@ -88,6 +114,16 @@ class AI(QGraphicsView):
                                self.height() * self.height())
         self.pixelsPerDeg = self.height() / self.pitchDegreesShown
         self.scene = QGraphicsScene(0, 0, sceneWidth, sceneHeight)
+        self.pixmap_cache = self.myparent.get_config_item('ai_pixmap_cache')
+        if self.pixmap_cache:
+            # The sky, ground and pitch ladder are drawn into scenes of their
+            # own and rasterized once, so that each frame only has to blit and
+            # rotate two pixmaps instead of redrawing gradients and text
+            self.background_scene = QGraphicsScene(0, 0, sceneWidth, sceneHeight)
+            ladder_scene = QGraphicsScene(0, 0, sceneWidth, sceneHeight)
+        else:
+            self.background_scene = self.scene
+            ladder_scene = self.scene
 
         # Get a failure scene ready in case it's needed
         self.fail_scene = QGraphicsScene(0, 0, sceneWidth, sceneHeight)
@@ -115,7 +151,7 @@ class AI(QGraphicsView):
             brush = self.gray_sky
         else:
             brush = self.gblue_brush
-        self.sky_rect = self.scene.addRect(0, 0, sceneWidth, sceneHeight / 2, self.blue_pen, brush)
+        self.sky_rect = self.background_scene.addRect(0, 0, sceneWidth, sceneHeight / 2, self.blue_pen, brush)
         self.setScene(self.scene)
         gradientBrown = QLinearGradient(0, sceneHeight / 2, 0, sceneHeight)
         gradientBrown.setColorAt(0.0, QColor(105, 46, 1))
@@ -132,7 +168,7 @@ class AI(QGraphicsView):
             brush = self.gray_land
         else:
             brush = self.gbrown_brush
-        self.land_rect = self.scene.addRect(0, sceneHeight / 2 + 1, sceneWidth, sceneHeight,
+        self.land_rect = self.background_scene.addRect(0, sceneHeight / 2 + 1, sceneWidth, sceneHeight,
                            self.brown_pen, brush)
 
         """ Not sure if this is needed or not:
@@ -160,7 +196,7 @@ class AI(QGraphicsView):
         #Draw the main horizontal line
         pen = QPen(QColor(Qt.white))
         pen.setWidth(2)
-        self.scene.addLine(0, sceneHeight / 2, sceneWidth, sceneHeight / 2, pen)
+        self.background_scene.addLine(0, sceneHeight / 2, sceneWidth, sceneHeight / 2, pen)
         #draw the degree hash marks
         pen.setWidth(2)
         pen.setColor(self.overlayColor)
@@ -177,21 +213,21 @@ class AI(QGraphicsView):
 
             # Draw the ticks above the line
             y = h / 2 - (self.pixelsPerDeg * 10) * i
-            self.scene.addLine(left, y, right, y, pen).setZValue(1)
+            ladder_scene.addLine(left, y, right, y, pen).setZValue(1)
             yy = y + self.pixelsPerDeg * 5
-            self.scene.addLine(left + inset, yy, right - inset, yy, pen).setZValue(1)
+            ladder_scene.addLine(left + inset, yy, right - inset, yy, pen).setZValue(1)
             # Draw the text for each of these
-            t = self.scene.addText(str(i * 10))
+            t = ladder_scene.addText(str(i * 10))
             t.setFont(f)
-            self.scene.setFont(f)
+            ladder_scene.setFont(f)
             t.setDefaultTextColor(self.overlayColor)
             t.setX(right + 5)
             t.setY(y - t.boundingRect().height() / 2)
             t.setZValue(1)
 
-            t = self.scene.addText(str(i * 10))
+            t = ladder_scene.addText(str(i * 10))
             t.setFont(f)
-            self.scene.setFont(f)
+            ladder_scene.setFont(f)
             t.setDefaultTextColor(self.overlayColor)
             t.setX(left - (t.boundingRect().width() + 5))
             t.setY(y - t.boundingRect().height() / 2)
@@ -199,53 +235,172 @@ class AI(QGraphicsView):
 
             # Draw the tick marks below the line
             y = h / 2 + (self.pixelsPerDeg * 10) * i
-            self.scene.addLine(left, y, right, y, pen).setZValue(1)
+            ladder_scene.addLine(left, y, right, y, pen).setZValue(1)
             yy = y - self.pixelsPerDeg * 5
-            self.scene.addLine(left + inset, yy, right - inset, yy, pen).setZValue(1)
+            ladder_scene.addLine(left + inset, yy, right - inset, yy, pen).setZValue(1)
             # Draw the text for these
             y = h / 2 + (self.pixelsPerDeg * 10) * i
-            t = self.scene.addText(str(i * - 10))
+            t = ladder_scene.addText(str(i * - 10))
             t.setFont(f)
-            self.scene.setFont(f)
+            ladder_scene.setFont(f)
             t.setDefaultTextColor(self.overlayColor)
             t.setX(right + 5)
             t.setY(y - t.boundingRect().height() / 2)
             t.setZValue(1)
 
-            t = self.scene.addText(str(i * - 10))
+            t = ladder_scene.addText(str(i * - 10))
             t.setFont(f)
-            self.scene.setFont(f)
+            ladder_scene.setFont(f)
             t.setDefaultTextColor(self.overlayColor)
             t.setX(left - (t.boundingRect().width() + 5))
             t.setY(y - t.boundingRect().height() / 2)
             t.setZValue(1)
+        if self.pixmap_cache:
+            self.background_item = self.scene.addPixmap(QPixmap())
+            self.ladder_item = self.scene.addPixmap(QPixmap())
+            self.ladder_item.setZValue(1)
+            rasterize(self.background_scene, self.background_item)
+            rasterize(ladder_scene, self.ladder_item)
+            self.smooth_pixmaps(True)
+        self.drawn_roll = None
         self.update_period = self.myparent.get_config_item('update_period')
         if self.update_period is None:
             self.update_period = .1
-        self.last_update_time = 0
         self.show_standard_turn = self.myparent.get_config_item('show_standard_turn')
         if self.show_standard_turn is None: self.show_standard_turn = True
+        # The flight director went with the old scene
+        self.fdtarget = None
+        self.fdon(self.fdondb.value)
         self.redraw()
+        if not self.composited:
+            self.frame_timer.start(int(self.update_period * 1000))
+
+    def setFrameClock(self, compositor):
+        """ Apply samples on the ticks of compositor's frame clock instead of
+            our own, and count them as painted once it has painted them on
+            the screen
+        """
+        self.composited = True
+        self.frame_timer.stop()
+        compositor.frameStarted.connect(self.frame)
+        compositor.framePainted.connect(self.painted)
+
+    def frame(self):
+        """ Tick of the frame clock. Applies whatever samples were latched
+            since the last tick.
+        """
+        if self.sample_time is not None:
+            self.redraw()
+        elif self.rolling:
+            self.smooth_pixmaps(True)
+
+    def smooth_pixmaps(self, smooth):
+        """ Set how the horizon and pitch ladder pixmaps are transformed """
+        mode = Qt.SmoothTransformation if smooth else Qt.FastTransformation
+        for item in (self.background_item, self.ladder_item):
+            if item is not None:
+                item.setTransformationMode(mode)
+        self.rolling = not smooth
 
     def redraw(self):
-        now = time.time()
-        if now - self.last_update_time < self.update_period:
-            return
-        self.last_update_time = now
-        self.resetTransform()
-        if self.fdondb.value and self.fdtarget_widget is not None:
-            self.fdtarget_widget.update (self.fdpitchdb.value, self.fdrolldb.value)
+        """ Show the latched pitch, roll and flight director values. The roll
+            goes into a single view transform, and the pitch into where it
+            is centered.
+        """
+        if self.fdondb.value and self.fdtarget is not None:
+            self.fdtarget.setTarget (self.fdpitchdb.value, self.fdrolldb.value)
+        rolling = self.drawn_roll is not None and self._rollAngle != self.drawn_roll
+        if rolling != self.rolling and self.background_item is not None:
+            self.smooth_pixmaps(not rolling)
+        self.drawn_roll = self._rollAngle
+        transform = QTransform()
+        transform.rotate(self._rollAngle * -1.0)
+        self.setTransform(transform)
         self.centerOn(self.scene.width() / 2,
                       self.scene.height() / 2 +
                       self._pitchAngle * self.pixelsPerDeg * - 1.0)
-        self.rotate(self._rollAngle * -1.0)
+        if self.sample_time is not None:
+            if self.applied_time is None:
+                self.applied_time = self.sample_time
+            self.sample_time = None
+
+    def latch(self):
+        """ Note that a sample arrived, to be applied on the next frame """
+        if self.sample_time is None:
+            self.sample_time = time.time()
+
+    def latency(self):
+        """ Returns (samples, mean, max) of the seconds from a sample arriving
+            to it being painted, since the last report
+        """
+        if self.latency_samples == 0:
+            return (0, 0.0, 0.0)
+        return (self.latency_samples, self.latency_total / self.latency_samples,
+                self.latency_max)
+
+    def painted(self):
+        """ Account for the latency of the samples just painted """
+        if self.applied_time is None:
+            return
+        now = time.time()
+        latency = now - self.applied_time
+        self.applied_time = None
+        self.latency_samples += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        if now - self.latency_report_time >= 10.0:
+            samples, mean, worst = self.latency()
+            log.debug ("AI latency over %d frames: mean %.0f ms, max %.0f ms",
+                        samples, mean * 1000, worst * 1000)
+            self.latency_samples = 0
+            self.latency_total = 0.0
+            self.latency_max = 0.0
+            self.latency_report_time = now
 
 # We use the paintEvent to draw on the viewport the parts that aren't moving.
+# They are drawn once into the overlay pixmap, which is redrawn on resize or
+# when the true airspeed moves to another TAS_BUCKET. Only the roll pointer
+# is painted every time.
     def paintEvent(self, event):
         super(AI, self).paintEvent(event)
         w = self.width()
         h = self.height()
+        tas = self.standard_turn_tas()
+        if self.overlay is None or self.overlay.width() != w or \
+                self.overlay.height() != h or tas != self.overlay_tas:
+            self.overlay = self.draw_overlay(w, h, tas)
+            self.overlay_tas = tas
+        if not self.composited:
+            self.painted()
         p = QPainter(self.viewport())
+        p.drawPixmap(0, 0, self.overlay)
+        p.setRenderHint(QPainter.Antialiasing)
+        pen = QPen(self.overlayColor)
+        pen.setWidth(1)
+        p.setPen(pen)
+        p.setBrush(QColor(Qt.white))
+        p.translate(w / 2, h / 2)
+        p.rotate(self._rollAngle * -1.0)
+        triangle = QPolygon([QPoint(0 + 7, - (h / 3) + 25),
+                             QPoint(0 - 7, -(h / 3) + 25),
+                             QPoint(0, - (h / 3 - 10))])
+        p.drawPolygon(triangle)
+
+    def standard_turn_tas(self):
+        """ The true airspeed the standard rate turn marks are drawn for,
+            rounded to TAS_BUCKET knots, or None if they aren't shown
+        """
+        if self.show_standard_turn and (not(self.fix_tas.fail)) and self.fix_tas.value > 30:
+            return round(self.fix_tas.value / AI.TAS_BUCKET) * AI.TAS_BUCKET
+        return None
+
+    def draw_overlay(self, w, h, tas):
+        """ Draw the aircraft symbol and the fixed bank angle marks into a
+            transparent pixmap the size of the widget
+        """
+        overlay = QPixmap(w, h)
+        overlay.fill(Qt.transparent)
+        p = QPainter(overlay)
         p.setRenderHint(QPainter.Antialiasing)
 
         p.setPen(QColor(Qt.black))
@@ -275,14 +430,14 @@ class AI(QGraphicsView):
             p.rotate(- 2 * angle)
             p.drawLine(longLine)
             p.rotate(angle)
-        if self.show_standard_turn and (not(self.fix_tas.fail)) and self.fix_tas.value > 30:
+        if tas is not None:
             srpen = QPen(self.srTurnColor)
             srpen.setWidth(3)
             p.setPen(srpen)
             #math.tan(_bank_angle_) = (rate_of_turn * tas_knots * 493/900) / 9.8(m/s)
             # standard rate of turn = 3 degrees per second
             rate_of_turn = math.radians(3)
-            tas_knots = self.fix_tas.value
+            tas_knots = tas
             #_bank_angle_ = math.atan((rate_of_turn * tas_knots * 493/900) / 9.8(m/s))
             srbank = math.atan((rate_of_turn * tas_knots * 493/900) / 9.8)
             srbank = math.degrees(srbank)
@@ -300,16 +455,8 @@ class AI(QGraphicsView):
                              QPoint(0 - 5, - (h / 3)),
                              QPoint(0, - (h / 3 - 10))])
         p.drawPolygon(triangle)
-
-        p.rotate(self._rollAngle * -1.0)
-        triangle = QPolygon([QPoint(0 + 7, - (h / 3) + 25),
-                             QPoint(0 - 7, -(h / 3) + 25),
-                             QPoint(0, - (h / 3 - 10))])
-        p.drawPolygon(triangle)
-        pen = QPen(QColor(Qt.magenta))
-        pen.setWidth(3)
-        p.setPen(pen)
-        p.setBrush(QBrush())
+        p.end()
+        return overlay
 
     # We don't want this responding to keystrokes
     def keyPressEvent(self, event):
@@ -322,7 +469,7 @@ class AI(QGraphicsView):
     def setRollAngle(self, angle):
         if angle != self._rollAngle and self.isVisible() and (not self._AIFail):
             self._rollAngle = efis.bounds(-180, 180, angle)
-            self.redraw()
+            self.latch()
 
     def getRollAngle(self):
         return self._rollAngle
@@ -354,6 +501,9 @@ class AI(QGraphicsView):
                     self.sky_rect.setBrush (self.gblue_brush)
                     self.land_rect.setBrush (self.gbrown_brush)
                     #self.old_text.hide()
+                if self.background_item is not None:
+                    rasterize(self.background_scene, self.background_item)
+                if not old:
                     self.redraw()
 
     def setAIBad(self, bad):
@@ -369,58 +519,62 @@ class AI(QGraphicsView):
                     self.sky_rect.setBrush (self.gblue_brush)
                     self.land_rect.setBrush (self.gbrown_brush)
                     #self.bad_text.hide()
+                if self.background_item is not None:
+                    rasterize(self.background_scene, self.background_item)
+                if not bad:
                     self.redraw()
 
     def setPitchAngle(self, angle):
         if angle != self._pitchAngle and self.isVisible() and (not self._AIFail):
             self._pitchAngle = efis.bounds(-90, 90, angle)
-            self.redraw()
+            self.latch()
 
     def getPitchAngle(self):
         return self._pitchAngle
 
     pitchAngle = property(getPitchAngle, setPitchAngle)
 
-
-class FDTarget(QGraphicsView):
+    def setFDAngle(self, angle):
+        # The flight director reads its items when it's drawn
+        if self.fdondb.value and self.fdtarget is not None:
+            self.latch()
+
+
+def rasterize(scene, item):
+    """ Paint everything in scene into the pixmap of item, which is placed
+        over the same part of its own scene
+    """
+    rect = scene.itemsBoundingRect().intersected(scene.sceneRect()).toAlignedRect()
+    pixmap = QPixmap(rect.size())
+    pixmap.fill(Qt.transparent)
+    p = QPainter(pixmap)
+    p.setRenderHint(QPainter.Antialiasing)
+    p.setRenderHint(QPainter.TextAntialiasing)
+    scene.render(p, QRectF(pixmap.rect()), QRectF(rect))
+    p.end()
+    item.setPixmap(pixmap)
+    item.setOffset(QPointF(rect.topLeft()))
+
+class FDTarget(QGraphicsPolygonItem):
+    """ Flight director bars, drawn in the AI scene so that they move with
+        the horizon. The polygon is built once; following the flight
+        director only changes the item's position and rotation.
+    """
+    WIDTH = 120
+    HEIGHT = 8
     def __init__(self, center, pixelsPerDeg, parent=None):
-        super(FDTarget, self).__init__(parent)
-        self.setStyleSheet("background-color: rgba(0, 0, 0, 0%); border: 0px")
-        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-        self.setRenderHint(QPainter.Antialiasing)
-        self.setFocusPolicy(Qt.NoFocus)
+        w2 = FDTarget.WIDTH / 2
+        h2 = FDTarget.HEIGHT / 2
+        super(FDTarget, self).__init__(QPolygonF([QPointF(-w2, -h2),
+                                                  QPointF( w2, -h2),
+                                                  QPointF( w2,  h2),
+                                                  QPointF(-w2,  h2)]), parent)
+        self.setPen(QPen(QColor(Qt.black)))
+        self.setBrush(QBrush(QColor(Qt.magenta)))
+        self.setZValue(2)
         self.aicenter = center
         self.pixelsPerDeg = pixelsPerDeg
 
-    def resizeEvent(self, event):
-        self.w = self.width()
-        self.h = self.height()
-        polyheight = 8
-        self.poly_points = [(-self.w/2,-polyheight/2)
-                           ,( self.w/2,-polyheight/2)
-                           ,( self.w/2, polyheight/2)
-                           ,(-self.w/2, polyheight/2)]
-
-        self.scene = QGraphicsScene(0, 0, self.w*2, self.w*2)
-        pen = QPen(QColor(Qt.black))
-        brush = QBrush (QColor (Qt.magenta))
-        ps = [QPointF (x,y) for x,y in self.poly_points]
-        fdpoly = QPolygonF (ps)
-        self.poly = self.scene.addPolygon (fdpoly, pen, brush)
-        self.poly.setX(self.w)
-        self.poly.setY(self.w)
-
-        self.setScene(self.scene)
-        self.aicenter.setX (self.aicenter.x()-self.w/2)
-        self.aicenter.setY (self.aicenter.y()-self.h/2)
-        self.centerOn (self.w, self.w)
-
-    def update(self, fdpitch, fdroll):
-        self.move (self.aicenter.x(), (self.aicenter.y() - fdpitch * self.pixelsPerDeg))
-        roll = fdroll * math.pi / 180
-        sinroll = math.sin(roll)
-        cosroll = math.cos(roll)
-        ps = [QPointF (cosroll*x - sinroll*y, sinroll*x + cosroll*y) for x,y in self.poly_points]
-        fdpoly = QPolygonF (ps)
-        self.poly.setPolygon (fdpoly)
+    def setTarget(self, fdpitch, fdroll):
+        self.setPos(self.aicenter.x(), self.aicenter.y() - fdpitch * self.pixelsPerDeg)
+        self.setRotation(fdroll)
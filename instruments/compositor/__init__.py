@@ -0,0 +1,257 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Draws a stack of overlapping instruments through a single widget.
+#
+# Normally each instrument on a screen is its own widget, and most of them
+# are QGraphicsViews with translucent backgrounds layered over the attitude
+# indicator. Whenever one of them changes, everything beneath it in that
+# rectangle is painted again, the attitude indicator included.
+#
+# In compositor mode each instrument becomes a window of its own that is
+# never shown on screen, where it keeps running as usual. Qt still sends an
+# instrument's window an update request whenever the instrument or one of
+# its children asks to be repainted; that marks the instrument dirty, and
+# the paint events that follow are dropped. Once per tick of the frame clock
+# each dirty instrument is rendered into a pixmap of its own, and only the
+# rectangles of those instruments are repainted, by blitting the pixmaps in
+# stacking order. Mouse and wheel events over the compositor are passed on
+# to the instrument underneath.
+
+try:
+    from PyQt5.QtGui import *
+    from PyQt5.QtCore import *
+    from PyQt5.QtWidgets import *
+except:
+    from PyQt4.QtGui import *
+    from PyQt4.QtCore import *
+import logging
+
+log = logging.getLogger(__name__)
+
+# Events that change where or whether an instrument is drawn, without
+# necessarily asking for a repaint
+LAYOUT_EVENTS = (QEvent.Move, QEvent.Resize, QEvent.Show, QEvent.Hide)
+MOUSE_EVENTS = (QEvent.MouseButtonPress, QEvent.MouseButtonRelease,
+                QEvent.MouseButtonDblClick, QEvent.MouseMove)
+
+class Compositor(QWidget):
+    # Emitted at the start of each frame, before the instruments that changed
+    # are rendered. Instruments that batch their updates apply them here.
+    frameStarted = pyqtSignal()
+    # Emitted once a frame has been painted on the screen
+    framePainted = pyqtSignal()
+
+    def __init__(self, parent=None, update_period=None):
+        super(Compositor, self).__init__(parent)
+        self.setFocusPolicy(Qt.NoFocus)
+        self.setMouseTracking(True)
+        self.parent_widget = parent
+        # Instruments, bottom first, and the ones not hidden on purpose.
+        # Like child widgets they are shown and hidden with the compositor.
+        self.layers = list()
+        self.shown = list()
+        self.pixmaps = dict()
+        self.rects = dict()
+        self.dirty = set()
+        # Layer of each instrument window and child widget being watched
+        self.owners = dict()
+        self.rendering = False
+        # Widget that was pressed, which gets the mouse until it's released
+        self.grabber = None
+        self.update_period = .1 if update_period is None else update_period
+        self.frame_timer = QTimer(self)
+        self.frame_timer.timeout.connect(self.frame)
+
+    def add(self, widget):
+        """ Composite widget above the ones already added. Its position
+            stays relative to the compositor's parent.
+        """
+        geometry = widget.geometry()
+        hidden = widget.isHidden() and widget.testAttribute(Qt.WA_WState_ExplicitShowHide)
+        widget.setParent(None)
+        widget.setAttribute(Qt.WA_DontShowOnScreen)
+        widget.setAttribute(Qt.WA_QuitOnClose, False)
+        if self.parent_widget is not None:
+            widget.setPalette(self.parent_widget.palette())
+            widget.setFont(self.parent_widget.font())
+            self.parent_widget.destroyed.connect(widget.deleteLater)
+        widget.setGeometry(geometry)
+        widget.destroyed.connect(lambda obj, widget=widget: self.forget(widget))
+        self.watch(widget, widget)
+        self.layers.append(widget)
+        if not hidden:
+            self.shown.append(widget)
+            if self.isVisible():
+                widget.show()
+        self.dirty.add(widget)
+
+    def forget(self, layer):
+        """ Stop compositing a layer that has been deleted """
+        for layers in (self.layers, self.shown):
+            if layer in layers:
+                layers.remove(layer)
+        for state in (self.pixmaps, self.rects):
+            state.pop(layer, None)
+        self.dirty.discard(layer)
+        for widget in [w for w, owner in self.owners.items() if owner is layer]:
+            del self.owners[widget]
+        if self.grabber is not None and self.owners.get(self.grabber) is None:
+            self.grabber = None
+
+    def watch(self, widget, layer):
+        """ Follow the repaints of widget and its children, as part of layer """
+        self.owners[widget] = layer
+        widget.installEventFilter(self)
+        for child in widget.findChildren(QWidget):
+            if child not in self.owners:
+                self.owners[child] = layer
+                child.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        layer = self.owners.get(obj)
+        if layer is None:
+            return False
+        t = event.type()
+        if t == QEvent.Paint:
+            # Instruments are only ever painted into their pixmaps
+            return not self.rendering
+        if t == QEvent.UpdateRequest or (obj is layer and t in LAYOUT_EVENTS):
+            self.dirty.add(layer)
+        elif t == QEvent.ChildAdded and event.child().isWidgetType():
+            self.watch(event.child(), layer)
+        return False
+
+    def showEvent(self, event):
+        for layer in self.shown:
+            layer.show()
+        self.dirty.update(self.layers)
+        self.frame_timer.start(int(self.update_period * 1000))
+
+    def hideEvent(self, event):
+        self.frame_timer.stop()
+        self.shown = [layer for layer in self.layers if not layer.isHidden()]
+        for layer in self.shown:
+            layer.hide()
+
+    def frame(self):
+        """ Tick of the frame clock. Renders the instruments that changed and
+            marks their rectangles for repainting.
+        """
+        self.frameStarted.emit()
+        # Whatever the tick changed has only posted update requests so far;
+        # deliver them so it makes this frame
+        for layer in self.layers:
+            QCoreApplication.sendPostedEvents(layer, QEvent.UpdateRequest)
+        for layer in self.layers:
+            if layer not in self.dirty:
+                continue
+            self.dirty.discard(layer)
+            rect = layer.geometry()
+            if not layer.isHidden() and rect.width() > 0 and rect.height() > 0:
+                self.rendering = True
+                try:
+                    self.pixmaps[layer] = render_layer(layer, self.pixmaps.get(layer))
+                finally:
+                    self.rendering = False
+            old_rect = self.rects.get(layer)
+            if old_rect is not None and old_rect != rect:
+                self.update(old_rect)
+            self.rects[layer] = rect
+            self.update(rect)
+
+    def paintEvent(self, event):
+        p = QPainter(self)
+        for layer in self.layers:
+            pixmap = self.pixmaps.get(layer)
+            rect = layer.geometry()
+            if pixmap is None or layer.isHidden() or not event.rect().intersects(rect):
+                continue
+            p.drawPixmap(rect.topLeft(), pixmap)
+        p.end()
+        self.framePainted.emit()
+
+    def layer_at(self, pos):
+        """ The top instrument shown at pos, or None """
+        for layer in reversed(self.layers):
+            if not layer.isHidden() and layer.geometry().contains(pos):
+                return layer
+        return None
+
+    def target_at(self, pos):
+        """ The widget an event at pos is for, or None """
+        layer = self.layer_at(pos)
+        if layer is None:
+            return None
+        widget = layer.childAt(pos - layer.geometry().topLeft())
+        return layer if widget is None else widget
+
+    def map_to(self, widget, pos):
+        """ Map pos from the compositor into widget """
+        layer = self.owners[widget]
+        local = pos - layer.geometry().topLeft()
+        return local if widget is layer else widget.mapFrom(layer, local)
+
+    def event(self, event):
+        t = event.type()
+        if t in MOUSE_EVENTS:
+            return self.forward_mouse(event)
+        if t == QEvent.Wheel:
+            return self.forward_wheel(event)
+        return super(Compositor, self).event(event)
+
+    def forward_mouse(self, event):
+        widget = self.grabber
+        if widget is None:
+            widget = self.target_at(event.pos())
+        if event.type() == QEvent.MouseButtonPress:
+            self.grabber = widget
+        elif event.type() == QEvent.MouseButtonRelease and not event.buttons():
+            self.grabber = None
+        if widget is None:
+            event.ignore()
+            return False
+        pos = self.map_to(widget, event.pos())
+        forwarded = QMouseEvent(event.type(), QPointF(pos), QPointF(event.windowPos()),
+                                QPointF(event.screenPos()), event.button(),
+                                event.buttons(), event.modifiers())
+        QApplication.sendEvent(widget, forwarded)
+        event.setAccepted(forwarded.isAccepted())
+        return True
+
+    def forward_wheel(self, event):
+        widget = self.target_at(event.pos())
+        if widget is None:
+            event.ignore()
+            return False
+        pos = self.map_to(widget, event.pos())
+        forwarded = QWheelEvent(QPointF(pos), event.globalPosF(), event.pixelDelta(),
+                                event.angleDelta(), event.buttons(), event.modifiers(),
+                                event.phase(), event.inverted(), event.source())
+        QApplication.sendEvent(widget, forwarded)
+        event.setAccepted(forwarded.isAccepted())
+        return True
+
+def render_layer(widget, pixmap=None):
+    """ Render widget and its children into a transparent pixmap, reusing
+        the given one if it is still the right size
+    """
+    if pixmap is None or pixmap.size() != widget.size():
+        pixmap = QPixmap(widget.size())
+    pixmap.fill(Qt.transparent)
+    # QGraphicsView.render() takes a painter, so use the QWidget one
+    QWidget.render(widget, pixmap, QPoint(), QRegion(), QWidget.DrawChildren)
+    return pixmap
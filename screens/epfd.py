@@ -31,6 +31,7 @@ from instruments import airspeed
 from instruments import altimeter
 from instruments import vsi
 from instruments import tc
+from instruments.compositor import Compositor
 
 class Screen(QWidget):
     def __init__(self, parent=None):
@@ -60,7 +61,22 @@ class Screen(QWidget):
         self.check_engine = CheckEngine(self)
         self.tc = tc.TurnCoordinator(self, dial=False)
 
+        # Optionally draw the instruments that overlap the AI through one
+        # widget instead of stacking them. The turn coordinator blends its
+        # background into what is beneath it, so it stays on top on its own.
+        self.compositor = None
+        if self.get_config_item('compositor'):
+            self.compositor = Compositor(self, self.get_config_item('update_period'))
+            for widget in (self.ai, self.alt_tape, self.alt_Trend, self.as_tape,
+                           self.asd_Box, self.hsi, self.heading_disp, self.alt_setting,
+                           self.check_engine):
+                self.compositor.add(widget)
+            self.ai.setFrameClock(self.compositor)
+            self.compositor.lower()
+
     def resizeEvent(self, event):
+        if self.compositor is not None:
+            self.compositor.resize(self.width(), self.height())
         instWidth = self.width()- 80
         instHeight = self.height() - 130
         self.ai.move(0, 40)
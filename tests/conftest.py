@@ -0,0 +1,65 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import sys
+import time
+
+import pytest
+
+# Qt widgets are only ever drawn offscreen in the tests
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# An 8000 foot north-south test runway at 5000 feet
+LAT = 35.0
+LNG = -105.5
+ELEVATION = 5000
+LENGTH = 8000
+
+@pytest.fixture(scope="session")
+def app():
+    QtWidgets = pytest.importorskip("PyQt5.QtWidgets")
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+def wait_until(done, step, timeout=5):
+    """ Call step until done() is true, failing after timeout seconds """
+    deadline = time.time() + timeout
+    while not done():
+        if time.time() > deadline:
+            raise AssertionError("gave up waiting after %d seconds"%timeout)
+        step()
+        time.sleep(.005)
+
+def make_runway(name, lat, bearing, length=LENGTH):
+    """ One end of a test runway """
+    from pyavtools import CIFPObjects
+    rw = CIFPObjects.Runway()
+    rw.airport_id = "KTST"
+    rw.name = name
+    rw.lat = lat
+    rw.lng = LNG
+    rw.bearing = bearing
+    rw.length = length
+    rw.elevation = ELEVATION
+    return rw
+
+def find_objects(dbpath, index_path, lat, lng):
+    """ Stands in for CIFPObjects.find_objects with the test runway """
+    from instruments.ai.VirtualVfr import FEET_NM
+    far_lat = LAT + LENGTH / FEET_NM / 60.0
+    return [rw for rw in (make_runway("RW36", LAT, 0.0), make_runway("RW18", far_lat, 180.0))
+                if (int(rw.lat), int(rw.lng)) == (lat, lng)]
@@ -0,0 +1,98 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import pytest
+
+pytest.importorskip("PyQt5")
+CIFPObjects = pytest.importorskip("pyavtools.CIFPObjects")
+from instruments.ai import VirtualVfr as vvfr
+from conftest import make_runway, wait_until
+
+def settle(pov, lat, lng):
+    """ Fly to lat, lng and wait for the window around it to be swapped in """
+    pov.gps_lat = lat
+    pov.gps_lng = lng
+    wait_until(lambda: pov.window == vvfr.cache_window(*pov.window_center()),
+               pov.update_cache)
+
+def test_empty_blocks_are_evicted(monkeypatch):
+    monkeypatch.setattr(CIFPObjects, "find_objects", lambda db, index, lat, lng: [])
+    budget = 5 * vvfr.PointOfView.BLOCK_OVERHEAD
+    pov = vvfr.PointOfView("db", "index", .1, cache_budget=budget / (1024.0 * 1024.0))
+    try:
+        for lng in range(-120, -90):
+            settle(pov, 30.5, lng + .5)
+            assert len(pov.object_cache) <= len(pov.window) + 5
+            assert set(pov.cache_bytes) == set(pov.object_cache)
+            assert set(pov.block_tables) == set(pov.object_cache)
+    finally:
+        pov.stop()
+
+def test_failed_blocks_load_empty(monkeypatch):
+    def find_objects(db, index, lat, lng):
+        if lat == 35:
+            raise IOError("corrupt index")
+        return []
+    monkeypatch.setattr(CIFPObjects, "find_objects", find_objects)
+    pov = vvfr.PointOfView("db", "index", .1)
+    try:
+        settle(pov, 35.5, -104.5)
+        assert pov.object_cache[(35, -105)] == []
+        assert len(pov.block_tables[(35, -105)].point_ids) == 0
+        assert pov.tile_loader.is_alive()
+        assert pov.tile_loader.pending == {}
+    finally:
+        pov.stop()
+
+def split_runway(db, index, lat, lng):
+    """ A runway with its ends in blocks (35, -105) and (36, -105) """
+    return [rw for rw in (make_runway("RW36", 35.99, 0.0, 9000),
+                          make_runway("RW18", 36.015, 180.0, 9000))
+                if (int(rw.lat), int(rw.lng)) == (lat, lng)]
+
+def window_runways(pov):
+    """ Runway rows drawn in the window, and runway ends still waiting """
+    waiting = [rw.name for block in pov.window for rw in pov.object_cache[block]]
+    return sorted(pov.window_table.runway_names.tolist()), waiting
+
+@pytest.mark.parametrize("away", [34.5, 37.5])
+def test_runways_pair_again_after_eviction(monkeypatch, away):
+    monkeypatch.setattr(CIFPObjects, "find_objects", split_runway)
+    # Room for one window of blocks, so that leaving it evicts the old one
+    budget = 10 * vvfr.PointOfView.BLOCK_OVERHEAD
+    pov = vvfr.PointOfView("db", "index", .1, cache_budget=budget / (1024.0 * 1024.0))
+    try:
+        settle(pov, 35.5, -105.5)
+        rows, waiting = window_runways(pov)
+        assert len(rows) == 1 and waiting == []
+        # Fly away far enough that one of the blocks holding an end is
+        # evicted, but not the other
+        settle(pov, away, -105.5)
+        evicted = (36, -105) if away < 35 else (35, -105)
+        assert evicted not in pov.object_cache
+        assert len(pov.object_cache) <= len(pov.window) + 1
+        for block in pov.object_cache:
+            for rw in pov.object_cache[block]:
+                assert not rw.matched()
+        settle(pov, 35.5, -105.5)
+        rows, waiting = window_runways(pov)
+        assert len(rows) == 1 and waiting == []
+        # Least recently used blocks go first
+        settle(pov, away, -105.5)
+        settle(pov, 35.5, -105.5)
+        assert list(pov.object_cache.keys())[-len(pov.window):] == pov.window
+    finally:
+        pov.stop()
@@ -0,0 +1,138 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import pytest
+
+pytest.importorskip("PyQt5")
+from PyQt5.QtGui import *
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtTest import QTest
+
+from instruments.compositor import Compositor
+
+class Block(QWidget):
+    """ Fills itself with a color, and records its paints and clicks """
+    def __init__(self, color, parent=None):
+        super(Block, self).__init__(parent)
+        self.color = QColor(color)
+        self.paints = 0
+        self.presses = list()
+
+    def paintEvent(self, event):
+        self.paints += 1
+        p = QPainter(self)
+        p.fillRect(self.rect(), self.color)
+        p.end()
+
+    def mousePressEvent(self, event):
+        self.presses.append(event.pos())
+
+class Overlay(QGraphicsView):
+    """ Translucent view with one white square, like the tapes over the AI """
+    def __init__(self, parent=None):
+        super(Overlay, self).__init__(parent)
+        self.setStyleSheet("background: transparent")
+        self.setFrameShape(QFrame.NoFrame)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.scene = QGraphicsScene(0, 0, 60, 60)
+        self.square = self.scene.addRect(0, 0, 20, 20, QPen(Qt.NoPen), QBrush(Qt.white))
+        self.setScene(self.scene)
+
+def settle(app):
+    for i in range(5):
+        app.processEvents()
+
+def color_at(widget, x, y):
+    return widget.grab().toImage().pixelColor(x, y).name()
+
+@pytest.fixture
+def screen(app):
+    parent = QWidget()
+    parent.resize(200, 200)
+    bottom = Block(Qt.red, parent)
+    bottom.setGeometry(0, 0, 200, 200)
+    top = Block(Qt.blue, parent)
+    top.setGeometry(150, 150, 40, 40)
+    overlay = Overlay(parent)
+    overlay.setGeometry(100, 20, 60, 60)
+    compositor = Compositor(parent, .02)
+    for widget in (bottom, top, overlay):
+        compositor.add(widget)
+    compositor.resize(200, 200)
+    parent.show()
+    settle(app)
+    compositor.frame()
+    settle(app)
+    yield compositor, bottom, top, overlay
+    parent.close()
+    parent.deleteLater()
+    settle(app)
+
+def test_layers_are_drawn_in_order(screen):
+    compositor, bottom, top, overlay = screen
+    assert color_at(compositor, 10, 10) == "#ff0000"
+    assert color_at(compositor, 160, 160) == "#0000ff"
+    # The view's square is drawn over the red, its transparent rest isn't
+    assert color_at(compositor, 105, 25) == "#ffffff"
+    assert color_at(compositor, 150, 70) == "#ff0000"
+
+def test_only_changed_layers_are_rendered(app, screen):
+    compositor, bottom, top, overlay = screen
+    paints = bottom.paints
+    top.color = QColor(Qt.green)
+    top.update()
+    settle(app)
+    # Nothing reaches the screen until the frame clock ticks
+    assert color_at(compositor, 160, 160) == "#0000ff"
+    compositor.frame()
+    assert color_at(compositor, 160, 160) == "#00ff00"
+    assert bottom.paints == paints
+    # Scene changes inside a view count too
+    overlay.square.setPos(20, 20)
+    settle(app)
+    compositor.frame()
+    assert color_at(compositor, 105, 25) == "#ff0000"
+    assert color_at(compositor, 125, 45) == "#ffffff"
+    assert bottom.paints == paints
+
+def test_frame_signals(app, screen):
+    compositor, bottom, top, overlay = screen
+    started = list()
+    painted = list()
+    compositor.frameStarted.connect(lambda: started.append(True))
+    compositor.framePainted.connect(lambda: painted.append(True))
+    top.update()
+    compositor.frame()
+    settle(app)
+    assert started and painted
+
+def test_hidden_layers_are_not_drawn(app, screen):
+    compositor, bottom, top, overlay = screen
+    top.hide()
+    compositor.frame()
+    assert color_at(compositor, 160, 160) == "#ff0000"
+    top.show()
+    compositor.frame()
+    assert color_at(compositor, 160, 160) == "#0000ff"
+
+def test_mouse_goes_to_the_top_layer(app, screen):
+    compositor, bottom, top, overlay = screen
+    QTest.mouseClick(compositor, Qt.LeftButton, Qt.NoModifier, QPoint(155, 165))
+    QTest.mouseClick(compositor, Qt.LeftButton, Qt.NoModifier, QPoint(20, 30))
+    assert top.presses == [QPoint(5, 15)]
+    assert bottom.presses == [QPoint(20, 30)]
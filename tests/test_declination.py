@@ -0,0 +1,69 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+
+import numpy as np
+import pytest
+
+geomag = pytest.importorskip("geomag")
+pytest.importorskip("PyQt5")
+from instruments.ai import Declination
+from conftest import wait_until
+
+def linear_grid():
+    """ A grid whose values are 2 lat + 3 lng, which interpolates exactly """
+    lats = 30 + np.arange(5) * 2.0
+    lngs = -110 + np.arange(7) * 2.0
+    return (30.0, -110.0, 2.0, 2 * lats[:,np.newaxis] + 3 * lngs[np.newaxis,:])
+
+def test_interpolate_is_exact_on_a_plane():
+    grid = linear_grid()
+    for lat, lng in ((30.0, -110.0), (31.3, -105.1), (38.0, -98.0), (37.99, -98.01)):
+        assert Declination.interpolate(grid, lat, lng) == pytest.approx(2 * lat + 3 * lng)
+
+def test_interpolate_outside_grid():
+    grid = linear_grid()
+    assert Declination.interpolate(grid, 29.9, -105.0) is None
+    assert Declination.interpolate(grid, 35.0, -97.9) is None
+
+def test_grid_matches_geomag():
+    grid = Declination.compute_grid((35.2, 38.5, -106.7, -101.1), Declination.DeclinationGrid.RESOLUTION)
+    lat0, lng0, resolution, values = grid
+    # Snapped outward to whole grid points
+    assert (lat0, lng0) == (34.0, -108.0)
+    assert values.shape == (4, 5)
+    for lat, lng in ((35.5, -106.0), (37.1, -102.3), (38.4, -101.2)):
+        assert Declination.interpolate(grid, lat, lng) == \
+                pytest.approx(geomag.declination(lat, lng, 0), abs=.05)
+
+def test_built_in_slices_and_saved(app, tmp_path, monkeypatch):
+    # One point per timer tick
+    monkeypatch.setattr(Declination.DeclinationGrid, "SLICE_TIME", 0)
+    path = str(tmp_path / "declination.npz")
+    region = [35, 39, -107, -101]
+    grid = Declination.DeclinationGrid(path, region)
+    assert grid.lookup(37.0, -104.0) is None
+    app.processEvents()
+    assert grid.grid is None and 0 < grid.builder.done < 20
+    wait_until(lambda: grid.grid is not None, app.processEvents, 10)
+    md = grid.lookup(37.0, -104.0)
+    assert md == pytest.approx(geomag.declination(37.0, -104.0, 0), abs=.05)
+    assert os.path.exists(path)
+    # A new grid reads the saved one instead of computing it again
+    saved = Declination.DeclinationGrid(path, region)
+    assert saved.lookup(37.0, -104.0) == md
+    assert saved.builder is None
@@ -0,0 +1,76 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import math
+
+import pytest
+
+pytest.importorskip("PyQt5")
+CIFPObjects = pytest.importorskip("pyavtools.CIFPObjects")
+from instruments.ai import VirtualVfr as vvfr
+from conftest import LAT, LNG, ELEVATION, find_objects, wait_until
+
+class Display:
+    """ Takes the render calls and ignores them """
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+@pytest.fixture
+def pov(monkeypatch):
+    monkeypatch.setattr(CIFPObjects, "find_objects", find_objects)
+    pov = vvfr.PointOfView("db", "index", .1)
+    pov.initialize(["Runway"], 600, LNG, LAT - .1, ELEVATION + 3000, 0.0)
+    wait_until(lambda: len(pov.window_table.runway_names) > 0, pov.update_cache)
+    assert len(pov.window_table.runway_names) == 1
+    yield pov
+    pov.stop()
+
+def approach_lod(pov, distance):
+    """ Level of detail of the runway seen from distance nautical miles out
+        on a 3 degree glide path
+    """
+    lat = LAT - distance / 60.0
+    alt = ELEVATION + math.tan(math.radians(3)) * distance * vvfr.FEET_NM + 50
+    pov.update(lat, LNG, 0.0, alt)
+    pov.render(Display())
+    return pov.runway_lods[(vvfr.RUNWAY, "RW36", "KTST")]
+
+@pytest.mark.parametrize("distance", [6, 5, 3, 1])
+def test_approach_shows_full_detail(pov, distance):
+    assert approach_lod(pov, distance) == vvfr.LOD_FULL
+
+def lods(pov, steps):
+    """ Levels of detail of one runway going through (size, distance) steps """
+    return [pov.runway_lod("hysteresis", size, distance) for size, distance in steps]
+
+def test_lod_hysteresis_distance(pov):
+    # Out past the full detail range and back. Each tier is held until 20%
+    # beyond its threshold, and only taken again inside it.
+    assert lods(pov, [(50, 9.5), (50, 11.0), (50, 12.4), (50, 12.6), (50, 11.0), (50, 10.0)]) == \
+        [vvfr.LOD_FULL, vvfr.LOD_FULL, vvfr.LOD_FULL, vvfr.LOD_LABELS, vvfr.LOD_LABELS, vvfr.LOD_FULL]
+
+def test_lod_hysteresis_size(pov):
+    # Labels need 12 pixels, held down to 9.6
+    assert lods(pov, [(11, 15), (12, 15), (10, 15), (9, 15), (11, 15)]) == \
+        [vvfr.LOD_OUTLINE, vvfr.LOD_LABELS, vvfr.LOD_LABELS, vvfr.LOD_OUTLINE, vvfr.LOD_OUTLINE]
+
+def test_lod_needs_outline(pov):
+    # Full detail has no size threshold, but nothing beyond a dot is drawn
+    # unless the outline fits
+    assert lods(pov, [(2, 5), (3, 5), (2.5, 5), (2, 5)]) == \
+        [vvfr.LOD_DOT, vvfr.LOD_FULL, vvfr.LOD_FULL, vvfr.LOD_DOT]
+    assert lods(pov, [(50, 45), (50, 35), (50, 45), (50, 51)]) == \
+        [vvfr.LOD_DOT, vvfr.LOD_OUTLINE, vvfr.LOD_OUTLINE, vvfr.LOD_DOT]
@@ -0,0 +1,82 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import math
+import random
+
+import pytest
+
+from instruments.ai.SpatialIndex import NearestIndex, OccupancyGrid
+
+def flat_distance(lat, lng, plat, plng, ref_lat):
+    dx = (plng - lng) * math.cos(math.radians(ref_lat))
+    return math.sqrt(dx * dx + (plat - lat) * (plat - lat)) * 60.0
+
+def test_nearest_matches_brute_force():
+    rng = random.Random(1)
+    lats = [35 + rng.uniform(-1.5, 1.5) for i in range(500)]
+    lngs = [-105 + rng.uniform(-1.5, 1.5) for i in range(500)]
+    index = NearestIndex(lats, lngs, list(range(500)), 35.0)
+    for i in range(50):
+        # Include positions well outside the points
+        lat = 35 + rng.uniform(-3, 3)
+        lng = -105 + rng.uniform(-3, 3)
+        expected = sorted((flat_distance(lat, lng, plat, plng, 35.0), i)
+                            for i, (plat, plng) in enumerate(zip(lats, lngs)))[:5]
+        found = index.nearest(lat, lng, 5)
+        assert [item for d, item in found] == [item for d, item in expected]
+        for (d, item), (ed, eitem) in zip(found, expected):
+            assert d == pytest.approx(ed)
+            assert type(d) is float
+
+def test_nearest_with_fewer_points_than_asked():
+    index = NearestIndex([35.0, 35.5], [-105.0, -105.0], ["A", "B"], 35.0)
+    found = index.nearest(35.4, -105.0, 5)
+    assert [item for d, item in found] == ["B", "A"]
+    assert found[0][0] == pytest.approx(6.0)
+
+def test_empty_index():
+    index = NearestIndex([], [], [], 35.0)
+    assert len(index) == 0
+    assert index.nearest(35.0, -105.0, 3) == []
+
+def overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+def test_occupancy_matches_brute_force():
+    rng = random.Random(2)
+    grid = OccupancyGrid()
+    placed = list()
+    for i in range(300):
+        left = rng.uniform(-50, 800)
+        top = rng.uniform(-50, 600)
+        rect = (left, top, left + rng.uniform(1, 120), top + rng.uniform(1, 40))
+        free = not any(overlaps(rect, p) for p in placed)
+        assert grid.occupied(rect) == (not free)
+        assert grid.place(rect) == free
+        if free:
+            placed.append(rect)
+    assert len(placed) > 10
+
+def test_occupancy_edges_and_clear():
+    grid = OccupancyGrid(cell_size=10)
+    assert grid.place((0, 0, 10, 10))
+    # Touching edges don't overlap, even across a cell boundary
+    assert grid.place((10, 0, 20, 10))
+    assert grid.place((0, 10, 10, 20))
+    assert not grid.place((9, 9, 11, 11))
+    grid.clear()
+    assert grid.place((9, 9, 11, 11))
@@ -0,0 +1,62 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import numpy as np
+import pytest
+
+from instruments.ai.Terrain import ElevationTiles, MAX_LEVEL, tile_name, FEET_METER
+
+def write_tile(directory, lat, lng, size):
+    """ A tile whose elevation in meters is the column number """
+    grid = np.tile(np.arange(size, dtype='>i2'), (size, 1))
+    grid.tofile(str(directory / tile_name(lat, lng)))
+
+@pytest.mark.parametrize("size", [1201, 3601])
+def test_levels_keep_the_edges(tmp_path, size):
+    write_tile(tmp_path, 35, -106, size)
+    tiles = ElevationTiles(str(tmp_path))
+    for level in range(MAX_LEVEL + 1):
+        grid = tiles.tile(35, -106, level)
+        # The east edge is the same place at every level
+        assert grid[0, 0] == 0
+        assert grid[0, -1] == size - 1
+        assert tiles.elevations([35.5], [-105.0 - 1e-9], level)[0] == pytest.approx((size - 1) * FEET_METER)
+
+@pytest.mark.parametrize("size", [1201, 3601])
+def test_spacing_picks_level_from_tile(tmp_path, size):
+    write_tile(tmp_path, 35, -106, size)
+    tiles = ElevationTiles(str(tmp_path))
+    # Four samples apart at level 0 reads level 2, whatever the resolution
+    spacing = 4.0 / (size - 1)
+    lng = -106 + 0.3
+    tiles.elevations([35.5], [lng], spacing=spacing)
+    assert 2 in tiles.tiles[(35, -106)]
+    assert 3 not in tiles.tiles[(35, -106)]
+    # Positions land within half a level 2 sample of where they are
+    height = tiles.elevations([35.5], [lng], spacing=spacing)[0] / FEET_METER
+    assert abs(height - 0.3 * (size - 1)) <= 2
+
+def test_levels_are_evicted_with_their_tile(tmp_path):
+    for lng in (-106, -105):
+        write_tile(tmp_path, 35, lng, 1201)
+    tiles = ElevationTiles(str(tmp_path), max_tiles=1)
+    for level in range(MAX_LEVEL + 1):
+        tiles.tile(35, -106, level)
+    assert list(tiles.tiles) == [(35, -106)]
+    assert sorted(tiles.tiles[(35, -106)]) == list(range(MAX_LEVEL + 1))
+    tiles.tile(35, -105, 2)
+    assert list(tiles.tiles) == [(35, -105)]
+    assert sorted(tiles.tiles[(35, -105)]) == [0, 1, 2]
@@ -0,0 +1,80 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import pytest
+
+pytest.importorskip("PyQt5")
+CIFPObjects = pytest.importorskip("pyavtools.CIFPObjects")
+from instruments.ai import TileStore
+from instruments.ai import VirtualVfr as vvfr
+from conftest import make_runway, wait_until
+
+def make_objects():
+    airport = CIFPObjects.Airport()
+    airport.id = "KTST"
+    airport.name = "TEST FIELD"
+    airport.lat, airport.lng = 35.02, -105.5
+    navaid = CIFPObjects.Navaid()
+    navaid.id = "TST"
+    navaid.name = "TEST VOR"
+    navaid.lat, navaid.lng = 35.1, -105.4
+    navaid.deviation = 8.0
+    return [airport, navaid, make_runway("RW36", 35.0, 0.0), make_runway("RW18", 35.04, 180.0)]
+
+@pytest.fixture
+def tilepath(tmp_path, monkeypatch):
+    """ A tile store compiled from a CIFP file of one line per object """
+    objects = make_objects()
+    cifp = tmp_path / "FAACIFP18"
+    cifp.write_bytes(b"".join(b"%d\n"%i for i in range(len(objects))))
+    monkeypatch.setattr(CIFPObjects, "parse_line",
+                        lambda fd: objects[int(fd.read())])
+    path = str(tmp_path / "tiles.bin")
+    assert TileStore.compile_tiles(str(cifp), path) == len(objects)
+    return path
+
+def test_round_trip(tilepath):
+    store = TileStore.TileStore(tilepath)
+    try:
+        runways, points = store.find_block(35, -105)
+        assert [(rw.name, rw.airport_id, rw.lat, rw.lng, rw.bearing, rw.length, rw.elevation)
+                    for rw in runways] == \
+               [(rw.name, rw.airport_id, rw.lat, rw.lng, rw.bearing, rw.length, rw.elevation)
+                    for rw in make_objects()[2:]]
+        assert points['type'].tolist() == [TileStore.AIRPORT, TileStore.NAVAID]
+        assert points['id'].tolist() == [b"KTST", b"TST"]
+        assert points['name'].tolist() == [b"TEST FIELD", b"TEST VOR"]
+        assert points['deviation'][1] == 8.0
+        assert store.find_block(36, -105)[0] == []
+        assert len(store.find_block(36, -105)[1]) == 0
+    finally:
+        store.close()
+
+def test_pov_loads_from_tile_store(tilepath):
+    pov = vvfr.PointOfView("db", "index", .1, tilepath=tilepath)
+    try:
+        pov.initialize(["Runway"], 600, -105.5, 34.9, 8000, 0.0)
+        wait_until(lambda: len(pov.window_table.runway_names) > 0, pov.update_cache)
+        table = pov.window_table
+        assert table.runway_names.tolist() == ["RW36"]
+        assert table.point_ids.tolist() == ["KTST", "TST"]
+        assert table.point_types.tolist() == [TileStore.AIRPORT, TileStore.NAVAID]
+        distance, elevation = pov.nearest_runways(1)[0]
+        assert type(distance) is float and type(elevation) is float
+        assert elevation == 5000
+        assert pov.nearest_airports(1)[0][1] == "KTST"
+    finally:
+        pov.stop()
@@ -0,0 +1,147 @@
+#  Copyright (c) 2018-2019 Garrett Herschleb
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import logging
+import time
+
+import pytest
+
+pytest.importorskip("PyQt5")
+CIFPObjects = pytest.importorskip("pyavtools.CIFPObjects")
+from PyQt5.QtCore import QPointF
+from PyQt5.QtWidgets import *
+import pyavtools.fix as fix
+from instruments.ai import AI
+from instruments.ai import VirtualVfr as vvfr
+from conftest import LAT, LNG, ELEVATION, find_objects, wait_until
+
+class Items:
+    """ Stands in for the FIX database, with every item valid """
+    def __init__(self):
+        self.items = dict()
+
+    def get_item(self, key, create=False, wait=True):
+        if key not in self.items:
+            item = fix.DB_Item(key)
+            item.min = -1000
+            item.max = 100000
+            item.bad = item.fail = item.old = False
+            self.items[key] = item
+        return self.items[key]
+
+class Screen(QWidget):
+    CONFIG = {'dbpath': 'db', 'indexpath': 'index', 'refresh_period': .02,
+              'update_period': .02}
+    def get_config_item(self, key):
+        return Screen.CONFIG.get(key)
+
+def run(app, seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        app.processEvents()
+        time.sleep(.005)
+
+@pytest.fixture
+def vfr(app, monkeypatch):
+    """ The display 5 nm out on a 3 degree approach to the test runway """
+    monkeypatch.setattr(CIFPObjects, "find_objects", find_objects)
+    monkeypatch.setattr(fix, "db", Items(), raising=False)
+    monkeypatch.setattr(fix, "log", logging.getLogger("fix"), raising=False)
+    # The attitude indicator overlay and the runway polygons pass float
+    # coordinates to Qt, which Python 3.10 and later no longer convert to int
+    monkeypatch.setattr(AI, "paintEvent",
+                        lambda self, event: QGraphicsView.paintEvent(self, event))
+    monkeypatch.setattr(vvfr, "QPoint", QPointF)
+    screen = Screen()
+    screen.resize(400, 300)
+    vfr = vvfr.VirtualVfr(screen)
+    vfr.resize(400, 300)
+    screen.show()
+    for key, value in (('LAT', LAT - 5 / 60.0), ('LONG', LNG), ('ALT', ELEVATION + 1600),
+                       ('HEAD', 0.0), ('PITCH', 0.0), ('ROLL', 0.0), ('TAS', 100)):
+        fix.db.get_item(key).value = value
+    wait_until(lambda: 'RW36KTST_p' in vfr.display_objects, app.processEvents)
+    yield vfr
+    vfr.pov.stop()
+    screen.close()
+    screen.deleteLater()
+    app.processEvents()
+
+def test_renders_runway_approach(app, vfr):
+    assert {'RW36KTST', 'RW36KTST_e', 'RW36KTST_p'} <= set(vfr.display_objects)
+    assert not vfr.rendering_prohibited
+    image = vfr.grab().toImage()
+    assert image.width() == 400 and not image.isNull()
+
+def test_steady_flight_creates_no_items(app, vfr):
+    vfr.items_created = 0
+    vfr.items_created_time = time.time()
+    for i in range(20):
+        fix.db.get_item('LAT').value = LAT - (5 - i * .01) / 60.0
+        fix.db.get_item('HEAD').value = i * .1
+        run(app, .03)
+    assert vfr.items_created == 0
+
+def test_only_replaced_updates_are_coalesced(app, vfr):
+    vfr.frame_timer.stop()
+    vfr.updates_coalesced = 0
+    # One fix per tick
+    for i in range(3):
+        fix.db.get_item('LAT').value = LAT - (4 - i * .01) / 60.0
+        fix.db.get_item('LONG').value = LNG + i * .001
+        vfr.apply_updates()
+    assert vfr.updates_coalesced == 0
+    # Two fixes and two altitudes in one tick
+    for i in range(2):
+        fix.db.get_item('LAT').value = LAT - (3 - i * .01) / 60.0
+        fix.db.get_item('LONG').value = LNG - i * .001
+        fix.db.get_item('ALT').value = ELEVATION + 1000 + i
+    vfr.apply_updates()
+    assert vfr.updates_coalesced == 2
+
+def test_updates_before_a_position_are_not_coalesced(app, vfr):
+    vfr.frame_timer.stop()
+    vfr.apply_updates()
+    vfr.updates_coalesced = 0
+    vfr.missing_lat = True
+    for i in range(3):
+        fix.db.get_item('ALT').value = ELEVATION + 1000 + i
+        vfr.apply_updates()
+    fix.db.get_item('LAT').value = LAT - 3 / 60.0
+    vfr.apply_updates()
+    assert vfr.updates_coalesced == 0
+
+def test_reading_the_items_is_not_coalesced(app, vfr):
+    vfr.frame_timer.stop()
+    vfr.apply_updates()
+    vfr.updates_coalesced = 0
+    vfr.setupItems()
+    vfr.setupItems()
+    vfr.apply_updates()
+    assert vfr.updates_coalesced == 0
+
+def test_papi_changes_redraw_only_full_detail(app, vfr):
+    vfr.frame_timer.stop()
+    points = ((-20.0, 60.0), (20.0, 60.0), (-4.0, 10.0), (4.0, 10.0))
+    def state(lod, height):
+        vfr.altitude = ELEVATION + height
+        vfr.render_runway(*points, 30000, ELEVATION, 8000, 0.0, "RW09", "KTST", 1.0, lod)
+        return vfr.runway_states["RW09KTST"]
+    for lod in (vvfr.LOD_DOT, vvfr.LOD_OUTLINE, vvfr.LOD_LABELS):
+        drawn = state(lod, 1600)
+        assert state(lod, 100) is drawn
+    drawn = state(vvfr.LOD_FULL, 1600)
+    assert state(vvfr.LOD_FULL, 100)[1:] == (4, vvfr.LOD_FULL)